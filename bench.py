@@ -0,0 +1,254 @@
+# -*- coding: utf-8 -*-
+# Нагрузочные замеры расчета цен без доступа к сети.
+# Генерирует синтетический лист RATEEXPIDR, подставляет его вместо Google Sheets и замеряет
+# задержки (p50/p90/p99), пропускную способность и пиковую память для основных сценариев.
+#
+#   python bench.py --rows 5000                       # прогон с выводом таблицы
+#   python bench.py --rows 5000 --save-baseline       # сохранить результаты как базовые
+#   python bench.py --rows 5000 --compare             # сравнить с базовыми, код выхода 1 при регрессии
+import argparse
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+
+import form
+
+BENCH_BASELINE_FILE = 'bench_baseline.json'
+# Во сколько раз p50 может вырасти относительно базового прогона, прежде чем это считается регрессией
+BENCH_REGRESSION_TOLERANCE = 1.25
+# Абсолютный запас для быстрых сценариев, где разброс таймера сравним с самим замером
+BENCH_REGRESSION_SLACK_MS = 0.05
+BENCH_REGRESSION_SLACK_KIB = 16
+# "Сегодня" для синтетического листа и для расчетов (SPOEXP, EARLY BIRD): с одним --seed прогоны в разные дни сравнимы
+BENCH_REFERENCE_DATE = date(2026, 1, 1)
+
+SHEET_HEADER = [
+    form.HEADER_KEY_REGION, form.HEADER_KEY_HOTELN, form.HEADER_KEY_CATEGORY,
+    form.HEADER_KEY_START_PERIOD, form.HEADER_KEY_END_PERIOD, form.HEADER_KEY_ROOM_IDR,
+    form.HEADER_KEY_FB_ADT, form.HEADER_KEY_FB_CHLD, form.HEADER_KEY_HB_ADT, form.HEADER_KEY_HB_CHLD,
+    form.HEADER_KEY_AI_ADT, form.HEADER_KEY_AI_CHLD, form.HEADER_KEY_EBED_ADT, form.HEADER_KEY_EBED_CHLD,
+    form.HEADER_KEY_NY_DINNER_ADT, form.HEADER_KEY_NY_DINNER_CHLD, form.HEADER_KEY_REMNYD, form.HEADER_KEY_BFST_CHLD,
+    form.HEADER_KEY_SPOEXP, form.HEADER_KEY_REMSPO, form.HEADER_KEY_EBIRD,
+    form.HEADER_KEY_REM1, form.HEADER_KEY_REM2, form.HEADER_KEY_CXL,
+]
+REGIONS = ['Ubud', 'Seminyak', 'Canggu', 'Nusa Dua', 'Jimbaran', 'Uluwatu', 'Sanur', 'Kuta']
+CATEGORIES = ['Deluxe Room', 'Superior Room', 'Pool Villa', 'One Bedroom Suite', 'Family Room', 'Ocean View Villa']
+
+
+# --- Синтетический лист ---
+def format_idr(amount: int) -> str:
+    # Цены в листе записаны по-разному: с пробелами-разделителями и без
+    return f"{amount:,}".replace(',', ' ') if amount % 2 else str(amount)
+
+def generate_rate_sheet(rows: int = 5000, categories_per_hotel: int = 4, periods_per_category: int = 12,
+                        reference_date: date = BENCH_REFERENCE_DATE, seed: int = 42) -> list:
+    # Значения листа (первая строка - заголовки), как их отдает worksheet.get_all_values().
+    # На каждую категорию: сезонные периоды на год вперед, перекрывающие их SPO и EARLY BIRD и период с новогодним ужином.
+    rng = random.Random(seed); first_day = reference_date.replace(day=1)
+    hotels = max(1, math.ceil(rows / (categories_per_hotel * periods_per_category)))
+    values = [list(SHEET_HEADER)]
+    for hotel_index in range(hotels):
+        region = REGIONS[hotel_index % len(REGIONS)]; hotel = f"Hotel {hotel_index:04d} {region} Resort"
+        for category in rng.sample(CATEGORIES, min(categories_per_hotel, len(CATEGORIES))):
+            base_price = rng.randrange(800_000, 6_000_000, 50_000)
+            for period_index in range(periods_per_category):
+                row = dict.fromkeys(SHEET_HEADER, '')
+                kind = rng.random()
+                if period_index == 0:
+                    # Период вокруг Нового года с обязательным ужином
+                    start = date(first_day.year, 12, 20); end = date(first_day.year + 1, 1, 10)
+                    row.update({form.HEADER_KEY_NY_DINNER_ADT: format_idr(rng.randrange(1_000_000, 3_000_000, 100_000)),
+                                form.HEADER_KEY_NY_DINNER_CHLD: format_idr(rng.randrange(400_000, 1_000_000, 100_000)),
+                                form.HEADER_KEY_REMNYD: "Gala dinner 31.12 is compulsory"})
+                else:
+                    start = first_day + timedelta(days=rng.randrange(0, 365)); end = start + timedelta(days=rng.randrange(7, 120))
+                price = int(base_price * rng.uniform(0.8, 1.4))
+                if kind < 0.15:
+                    row.update({form.HEADER_KEY_SPOEXP: (reference_date + timedelta(days=rng.randrange(-60, 180))).strftime(form.DATE_FORMAT),
+                                form.HEADER_KEY_REMSPO: f"Special offer {rng.choice([10, 15, 20, 25])}% off"})
+                    price = int(price * 0.8)
+                elif kind < 0.3:
+                    row[form.HEADER_KEY_EBIRD] = str(rng.choice([30, 45, 60, 90]))
+                    price = int(price * 0.85)
+                row.update({
+                    form.HEADER_KEY_REGION: region, form.HEADER_KEY_HOTELN: hotel, form.HEADER_KEY_CATEGORY: category,
+                    form.HEADER_KEY_START_PERIOD: start.strftime(form.DATE_FORMAT), form.HEADER_KEY_END_PERIOD: end.strftime(form.DATE_FORMAT),
+                    form.HEADER_KEY_ROOM_IDR: format_idr(price - price % 1000),
+                    form.HEADER_KEY_FB_ADT: format_idr(600_000), form.HEADER_KEY_FB_CHLD: format_idr(300_000),
+                    form.HEADER_KEY_HB_ADT: format_idr(350_000), form.HEADER_KEY_HB_CHLD: format_idr(175_000),
+                    form.HEADER_KEY_AI_ADT: format_idr(1_200_000), form.HEADER_KEY_AI_CHLD: format_idr(600_000),
+                    form.HEADER_KEY_EBED_ADT: format_idr(750_000), form.HEADER_KEY_EBED_CHLD: format_idr(450_000),
+                    form.HEADER_KEY_BFST_CHLD: format_idr(150_000),
+                    form.HEADER_KEY_REM1: rng.choice(['', 'Daily breakfast', 'Daily breakfast, airport transfer']),
+                    form.HEADER_KEY_REM2: rng.choice(['', 'Child under 12 stays free sharing bed']),
+                    form.HEADER_KEY_CXL: rng.choice(['', '14 days prior to arrival', '30 days prior to arrival']),
+                })
+                values.append([row[key] for key in SHEET_HEADER])
+    return values
+
+class FakeSpreadsheet:
+    def __init__(self): self.update_counter = 0
+    def get_lastUpdateTime(self): return f"fake-{self.update_counter}"
+
+class FakeWorksheet:
+    # Замена gspread.Worksheet: ровно то, что использует RateSheetSync (общая для замеров и тестов)
+    def __init__(self, values: list):
+        self.spreadsheet = FakeSpreadsheet(); self.values = values; self.fetches = 0
+    def get_all_values(self):
+        self.fetches += 1
+        return [list(row) for row in self.values]
+    def touch(self):
+        # Как правка документа: меняется время изменения
+        self.spreadsheet.update_counter += 1
+
+def install_fake_sheet(values: list) -> FakeWorksheet:
+    worksheet = FakeWorksheet(values)
+    form.rate_sheet_cache = form.RateSheetCache(form.RateSheetSync(lambda: worksheet, snapshot_path=None))
+    form.quote_cache.clear()
+    return worksheet
+
+def freeze_today(reference_date: date):
+    # Расчеты берут "сегодня" из date.today(); подменяем его опорной датой, чтобы действие спецпредложений не зависело от дня прогона
+    class ReferenceDate(date):
+        @classmethod
+        def today(cls): return reference_date
+    form.date = ReferenceDate
+
+
+# --- Замеры ---
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values: return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+def measure(operation, iterations: int, setup=None) -> dict:
+    latencies = []
+    operation(0)  # прогрев
+    started = time.perf_counter()
+    for i in range(iterations):
+        if setup: setup(i)
+        t0 = time.perf_counter(); operation(i); latencies.append(time.perf_counter() - t0)
+    elapsed = time.perf_counter() - started
+    # Пиковая память - отдельным прогоном, tracemalloc заметно замедляет код
+    tracemalloc.start()
+    if setup: setup(iterations)
+    operation(iterations)
+    _, peak_bytes = tracemalloc.get_traced_memory(); tracemalloc.stop()
+    latencies.sort()
+    return {'iterations': iterations, 'p50_ms': percentile(latencies, 0.5) * 1000, 'p90_ms': percentile(latencies, 0.9) * 1000,
+            'p99_ms': percentile(latencies, 0.99) * 1000, 'mean_ms': statistics.fmean(latencies) * 1000,
+            'throughput_per_s': iterations / elapsed if elapsed else 0.0, 'peak_kib': peak_bytes / 1024}
+
+def random_stays(values: list, count: int, nights: int, seed: int, reference_date: date = BENCH_REFERENCE_DATE) -> list:
+    rng = random.Random(seed); rows = values[1:]; first_day = reference_date.replace(day=1)
+    stays = []
+    for _ in range(count):
+        row = rng.choice(rows); checkin = first_day + timedelta(days=rng.randrange(0, 365))
+        stays.append({'region': row[0], 'hotel': row[1], 'category': row[2], 'checkin_date': checkin.strftime(form.DATE_FORMAT),
+                      'checkout_date': (checkin + timedelta(days=nights)).strftime(form.DATE_FORMAT),
+                      'adults_count': 2, 'children_count': rng.choice([0, 1, 2]), 'usd_rate': '16400',
+                      'additional_options': rng.choice(['', 'HB', 'FB, extra bed', 'sharing bed'])})
+    return stays
+
+def run_benchmarks(rows: int, iterations: int, seed: int, scenarios=None, reference_date: date = BENCH_REFERENCE_DATE) -> dict:
+    values = generate_rate_sheet(rows, reference_date=reference_date, seed=seed)
+    freeze_today(reference_date); install_fake_sheet(values)
+    client = form.app.test_client()
+    snapshot = form.rate_sheet_cache.get()
+    stays = random_stays(values, iterations + 2, 3, seed, reference_date)
+    long_stays = random_stays(values, iterations + 2, 21, seed + 1, reference_date)
+    clear_quote_cache = lambda i: form.quote_cache.clear()
+    directory_etag = client.get('/api/hotels').headers['ETag']  # вне замера: сценарий 304 меряет только условный запрос
+
+    def sheet_load(i):
+        sheet_sync = form.RateSheetSync(lambda: FakeWorksheet(values), snapshot_path=None); sheet_sync.sync()
+
+    def batch_quotes(i):
+        hotels = sorted({stay['hotel'] for stay in stays[:10]})
+        client.post('/api/quotes', json={'matrix': {'hotels': hotels, 'categories': CATEGORIES[:3],
+                    'stays': [{'checkin_date': stay['checkin_date'], 'checkout_date': stay['checkout_date']} for stay in stays[i % 3:i % 3 + 3]],
+                    'adults_count': 2, 'children_count': 1, 'additional_options': 'HB'}})
+
+    all_scenarios = {
+        'sheet_load': (sheet_load, None),
+        'hotel_directory': (lambda i: client.get('/api/hotels'), None),
+        'single_quote': (lambda i: form.calculate_price_for_web(dict(stays[i]), snapshot), clear_quote_cache),
+        'single_quote_cached': (lambda i: form.calculate_price_for_web(dict(stays[0]), snapshot), None),
+        'long_stay_21_nights': (lambda i: form.calculate_price_for_web(dict(long_stays[i]), snapshot), clear_quote_cache),
+        'batch_quotes_90': (batch_quotes, clear_quote_cache),
+        'index_render': (lambda i: client.get('/'), None),
+        'metrics_scrape': (lambda i: client.get('/metrics'), None),
+        'hotel_directory_304': (lambda i: client.get('/api/hotels', headers={'If-None-Match': directory_etag}), None),
+        'calculate_route': (lambda i: client.post('/calculate_price', data=dict(stays[i], checkin_date=date_to_iso(stays[i]['checkin_date']),
+                                                  checkout_date=date_to_iso(stays[i]['checkout_date']))), clear_quote_cache),
+    }
+    if form.np is not None:
+        all_scenarios['calendar_365'] = (lambda i: client.get('/api/calendar', query_string={
+            'hotel': stays[i]['hotel'], 'category': stays[i]['category'], 'nights': 7, 'days': 365}), None)
+    results = {}
+    for name, (operation, setup) in all_scenarios.items():
+        if scenarios and name not in scenarios: continue
+        results[name] = measure(operation, iterations, setup)
+    return {'rows': len(values) - 1, 'table_rows': len(snapshot.rate_table), 'iterations': iterations, 'seed': seed,
+            'reference_date': reference_date.isoformat(), 'python': sys.version.split()[0], 'scenarios': results}
+
+def date_to_iso(value: str) -> str:
+    return form.datetime.strptime(value, form.DATE_FORMAT).strftime('%Y-%m-%d')
+
+def print_report(report: dict, baseline: dict = None):
+    print(f"Строк в листе: {report['rows']} (в таблице тарифов: {report['table_rows']}), итераций: {report['iterations']}")
+    print(f"{'сценарий':<24}{'p50 мс':>10}{'p90 мс':>10}{'p99 мс':>10}{'оп/с':>10}{'пик КиБ':>10}{'к базе':>9}")
+    for name, result in report['scenarios'].items():
+        base = (baseline or {}).get('scenarios', {}).get(name)
+        ratio = f"{result['p50_ms'] / base['p50_ms']:.2f}x" if base and base['p50_ms'] else '-'
+        print(f"{name:<24}{result['p50_ms']:>10.3f}{result['p90_ms']:>10.3f}{result['p99_ms']:>10.3f}"
+              f"{result['throughput_per_s']:>10.1f}{result['peak_kib']:>10.0f}{ratio:>9}")
+
+def find_regressions(report: dict, baseline: dict, tolerance: float) -> list:
+    # Регрессией считается рост и задержки (p50), и пиковой памяти
+    regressions = []
+    for name, result in report['scenarios'].items():
+        base = baseline.get('scenarios', {}).get(name)
+        if not base: continue
+        if result['p50_ms'] > base['p50_ms'] * tolerance + BENCH_REGRESSION_SLACK_MS: regressions.append(f"{name} (p50)")
+        if 'peak_kib' in base and result['peak_kib'] > base['peak_kib'] * tolerance + BENCH_REGRESSION_SLACK_KIB: regressions.append(f"{name} (память)")
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Замеры скорости расчета цен на синтетическом листе тарифов")
+    parser.add_argument('--rows', type=int, default=5000, help="примерное число строк в листе")
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reference-date', type=date.fromisoformat, default=BENCH_REFERENCE_DATE,
+                        help="опорная дата листа и расчетов, ГГГГ-ММ-ДД (по умолчанию %(default)s)")
+    parser.add_argument('--scenario', action='append', dest='scenarios', help="запустить только этот сценарий (можно несколько раз)")
+    parser.add_argument('--baseline', default=BENCH_BASELINE_FILE, help="файл с базовыми результатами")
+    parser.add_argument('--save-baseline', action='store_true', help="сохранить результаты как базовые")
+    parser.add_argument('--compare', action='store_true', help="сравнить с базовыми и вернуть 1 при регрессии")
+    parser.add_argument('--tolerance', type=float, default=BENCH_REGRESSION_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.rows, args.iterations, args.seed, args.scenarios, args.reference_date)
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as baseline_file: baseline = json.load(baseline_file)
+        if baseline.get('rows') != report['rows']: print(f"Внимание: базовый прогон был на {baseline.get('rows')} строках")
+        if baseline.get('reference_date') != report['reference_date']:
+            print(f"Внимание: базовый прогон был с опорной датой {baseline.get('reference_date')}")
+    print_report(report, baseline)
+    if args.save_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as baseline_file: json.dump(report, baseline_file, ensure_ascii=False, indent=2)
+        print(f"Базовые результаты сохранены в {args.baseline}")
+    if args.compare:
+        if baseline is None: print(f"Нет базовых результатов ({args.baseline})"); return 1
+        regressions = find_regressions(report, baseline, args.tolerance)
+        if regressions: print(f"РЕГРЕССИЯ (p50 или пик памяти > {args.tolerance}x базового): {', '.join(regressions)}"); return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,15 +1,76 @@
 # -*- coding: utf-8 -*-
-from flask import Flask, render_template, request
+from flask import Flask, render_template, request, jsonify
+import click
 from datetime import datetime, timedelta, date 
 import gspread # type: ignore
-import traceback 
+from gspread.utils import numericise, numericise_all # type: ignore
+from gspread.exceptions import APIError # type: ignore
+import requests
 import re
-from collections import defaultdict
+import os
+import threading
+import time
+import random
+import hashlib
+import json
+import logging
+import mmap
+import multiprocessing
+import struct
+import sys
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import defaultdict, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from difflib import SequenceMatcher
+try:
+    import numpy as np
+except ImportError:  # векторный движок (/api/calendar) необязателен
+    np = None
 
 # --- ГЛОБАЛЬНЫЕ КОНСТАНТЫ ---
 GOOGLE_SHEET_ID = '1jBuLeH6o7HCmPswOScorR6nM1X7B4LrXooK4VmjpLAI' 
 GOOGLE_SHEET_TAB_NAME = 'RATEEXPIDR' 
 CREDENTIALS_FILE = 'credentials.json' 
+# Локальный бинарный снимок таблицы тарифов: воркер может стартовать без обращения к Google
+RATE_SNAPSHOT_FILE = os.environ.get('RATE_SNAPSHOT_FILE', 'rate_snapshot.bin')
+# Как часто фоновый поток перечитывает лист с тарифами (секунды)
+SHEET_CACHE_TTL_SECONDS = int(os.environ.get('SHEET_CACHE_TTL_SECONDS', '300'))
+# Пауза перед повторной попыткой, если обновление не удалось
+SHEET_CACHE_RETRY_SECONDS = int(os.environ.get('SHEET_CACHE_RETRY_SECONDS', '30'))
+# Запросы к Google Sheets: таймаут одного HTTP-запроса, число повторов и базовая пауза экспоненциального backoff
+SHEETS_TIMEOUT_SECONDS = float(os.environ.get('SHEETS_TIMEOUT_SECONDS', '20'))
+SHEETS_MAX_RETRIES = int(os.environ.get('SHEETS_MAX_RETRIES', '3'))
+SHEETS_RETRY_BASE_SECONDS = float(os.environ.get('SHEETS_RETRY_BASE_SECONDS', '1'))
+SHEETS_RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+# Сколько первый запрос воркера ждет первую загрузку листа, если локального снимка нет
+SHEET_INITIAL_LOAD_WAIT_SECONDS = float(os.environ.get('SHEET_INITIAL_LOAD_WAIT_SECONDS', '15'))
+# Ограничения пакетного расчета (/api/quotes)
+BATCH_MAX_QUOTES = 2000
+BATCH_MAX_NIGHTS = 366
+# Проживания одной группы, заезды которых ближе этого числа дней, разбираются одним проходом по датам
+BATCH_SWEEP_MAX_GAP_DAYS = 31
+# С какого числа промахов кэша пакет считается в пуле процессов. Расчет - чистый Python, поэтому пул потоков под GIL
+# был медленнее последовательного расчета (0.42 с против 0.39 с на 2000 расчетов по 14 ночей). Процессам нужен только
+# путь к файлу снимка, но результаты возвращаются через pickle: ~0.16 с на те же 2000 расчетов при ~0.29 с самого
+# расчета, поэтому пул окупается лишь на крупных пакетах и при нескольких ядрах (на одном ядре он выключен).
+BATCH_PROCESS_MIN_QUOTES = int(os.environ.get('BATCH_PROCESS_MIN_QUOTES', '500'))
+BATCH_MAX_WORKERS = int(os.environ.get('BATCH_MAX_WORKERS', str(min(4, os.cpu_count() or 1))))
+# Календарь цен (/api/calendar): максимум дат заезда и размер блока (тарифы x даты x ночи) для NumPy
+CALENDAR_MAX_DAYS = 731
+CALENDAR_CHUNK_CELLS = 4_000_000
+# Предел всей работы одного календаря (тарифы x даты x ночи): блоки ограничивают память, а этот предел - время
+CALENDAR_MAX_CELLS = int(os.environ.get('CALENDAR_MAX_CELLS', '100000000'))
+# Кэш готовых расчетов: максимум записей и примерный бюджет памяти
+QUOTE_CACHE_MAX_ENTRIES = int(os.environ.get('QUOTE_CACHE_MAX_ENTRIES', '5000'))
+QUOTE_CACHE_MAX_BYTES = int(os.environ.get('QUOTE_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+# Логи: уровень (DEBUG включает разбор по ночам) и формат строки - text или json
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'text')
+# Границы корзин гистограмм длительности этапов (секунды)
+METRICS_LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
 
 # --- Ключи заголовков для консистентности ---
 HEADER_KEY_HOTELN = 'HOTELN'
@@ -31,6 +92,104 @@ HEADER_KEY_REM2 = 'REM2'
 HEADER_KEY_CXL = 'CXL'   # <-- ДОБАВЛЕНО
 
 
+# --- Логирование ---
+logger = logging.getLogger('hotel_calculator')
+
+class StructuredLogFormatter(logging.Formatter):
+    # Поля из extra={...} выводятся отдельно от текста: key=value в текстовом формате, ключами объекта в JSON
+    RESERVED_ATTRS = frozenset(vars(logging.makeLogRecord({}))) | {'message', 'asctime'}
+
+    def __init__(self, as_json: bool = False):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s'); self.as_json = as_json
+
+    def extra_fields(self, record: logging.LogRecord) -> dict:
+        return {key: value for key, value in vars(record).items() if key not in self.RESERVED_ATTRS}
+
+    def formatMessage(self, record: logging.LogRecord) -> str:
+        # Текстовый формат: поля дописываются в строку сообщения, до трассировки исключения
+        line = super().formatMessage(record); fields = self.extra_fields(record)
+        return line if not fields else f"{line} " + ' '.join(f"{key}={value!r}" for key, value in fields.items())
+
+    def format(self, record: logging.LogRecord) -> str:
+        if not self.as_json: return super().format(record)
+        entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+        entry.update(self.extra_fields(record))
+        if record.exc_info: entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def configure_logging():
+    # Свой обработчик, если приложение (или gunicorn) не настроили логгер сами
+    if logger.handlers: return
+    handler = logging.StreamHandler(); handler.setFormatter(StructuredLogFormatter(as_json=LOG_FORMAT == 'json'))
+    logger.addHandler(handler); logger.propagate = False
+    # Опечатка в LOG_LEVEL не должна ронять воркер при импорте
+    try: logger.setLevel(LOG_LEVEL)
+    except ValueError:
+        logger.setLevel(logging.INFO); logger.warning("Неизвестный LOG_LEVEL, используется INFO", extra={'log_level': LOG_LEVEL})
+
+configure_logging()
+
+# --- Метрики (текстовый формат Prometheus) ---
+# Значения живут в памяти процесса: в gunicorn у каждого воркера свои, Prometheus различает их по адресу/pid
+def format_metric_labels(label_names: tuple, label_values: tuple) -> str:
+    if not label_names: return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in label_values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(label_names, escaped)) + '}'
+
+def format_metric_value(value) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+class MetricCounter:
+    def __init__(self, name: str, documentation: str, label_names: tuple = ()):
+        self.name = name; self.documentation = documentation; self.label_names = label_names
+        self._values = defaultdict(float); self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount: float = 1):
+        with self._lock: self._values[label_values] += amount
+
+    def exposition(self) -> list:
+        with self._lock: values = sorted(self._values.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        lines.extend(f"{self.name}{format_metric_labels(self.label_names, labels)} {format_metric_value(value)}" for labels, value in values)
+        return lines
+
+class MetricHistogram:
+    def __init__(self, name: str, documentation: str, label_names: tuple = (), buckets: tuple = METRICS_LATENCY_BUCKETS):
+        self.name = name; self.documentation = documentation; self.label_names = label_names; self.buckets = tuple(buckets)
+        self._series = {}; self._lock = threading.Lock()  # метки -> [счетчики по корзинам (последняя - +Inf), сумма]
+
+    def observe(self, value: float, *label_values):
+        bucket = bisect_left(self.buckets, value)  # корзина le включает саму границу
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None: series = self._series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bucket] += 1; series[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try: yield
+        finally: self.observe(time.perf_counter() - started, *label_values)
+
+    def exposition(self) -> list:
+        with self._lock: series_list = sorted((labels, list(counts), total) for labels, (counts, total) in self._series.items())
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, counts, total in series_list:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count; le = '+Inf' if bound == float('inf') else format_metric_value(bound)
+                lines.append(f"{self.name}_bucket{format_metric_labels(self.label_names + ('le',), labels + (le,))} {cumulative}")
+            lines.append(f"{self.name}_sum{format_metric_labels(self.label_names, labels)} {format_metric_value(total)}")
+            lines.append(f"{self.name}_count{format_metric_labels(self.label_names, labels)} {cumulative}")
+        return lines
+
+stage_seconds = MetricHistogram('hotel_calculator_stage_seconds', "Длительность этапов обработки", ('stage',))
+quotes_total = MetricCounter('hotel_calculator_quotes_total', "Выданные расчеты (включая взятые из кэша)", ('endpoint', 'result'))
+rate_not_found_nights_total = MetricCounter('hotel_calculator_rate_not_found_nights_total', "Ночи без тарифа (ТАРИФ НЕ НАЙДЕН) в выданных расчетах", ('endpoint',))
+sheets_errors_total = MetricCounter('hotel_calculator_sheets_errors_total', "Ошибки запросов к Google Sheets", ('stage', 'action'))
+sheet_syncs_total = MetricCounter('hotel_calculator_sheet_syncs_total', "Синхронизации листа тарифов", ('result',))
+METRICS = (stage_seconds, quotes_total, rate_not_found_nights_total, sheets_errors_total, sheet_syncs_total)
+
 # --- Вспомогательные функции ---
 def normalize_string(s: str) -> str:
     if not isinstance(s, str): s = str(s)
@@ -45,24 +204,465 @@ def clean_price_string(price_str: str) -> int:
         return int(float(cleaned_str))
     except (ValueError, TypeError): return 0
 
-def get_structured_hotel_data() -> dict:
-    try:
-        gc = gspread.service_account(filename=CREDENTIALS_FILE)
-        spreadsheet = gc.open_by_key(GOOGLE_SHEET_ID)
-        worksheet = spreadsheet.worksheet(GOOGLE_SHEET_TAB_NAME)
-        all_records = worksheet.get_all_records()
-        hotel_data = defaultdict(lambda: defaultdict(set))
-        for record in all_records:
-            region = str(record.get(HEADER_KEY_REGION, '')).strip()
-            hotel = str(record.get(HEADER_KEY_HOTELN, '')).strip()
-            category = str(record.get(HEADER_KEY_CATEGORY, '')).strip()
-            if region and hotel and category:
-                hotel_data[region][hotel].add(category)
-        final_data = { region: { hotel: sorted(list(categories)) for hotel, categories in hotels.items() } for region, hotels in hotel_data.items() }
-        return final_data
-    except Exception as e:
-        print(f"Ошибка при получении структурированных данных из Google Sheets: {e}")
+def open_rate_worksheet():
+    gc = gspread.service_account(filename=CREDENTIALS_FILE)
+    gc.set_timeout(SHEETS_TIMEOUT_SECONDS)
+    spreadsheet = gc.open_by_key(GOOGLE_SHEET_ID)
+    return spreadsheet.worksheet(GOOGLE_SHEET_TAB_NAME)
+
+def is_retryable_sheets_error(e: Exception) -> bool:
+    # Повторяем только временные сбои: таймауты, обрывы соединения, квоты (429) и ошибки сервера
+    if isinstance(e, APIError): return getattr(e.response, 'status_code', None) in SHEETS_RETRY_STATUS_CODES
+    return isinstance(e, requests.exceptions.RequestException)
+
+def build_hotel_tree(all_records: list) -> dict:
+    hotel_data = defaultdict(lambda: defaultdict(set))
+    for record in all_records:
+        region = str(record.get(HEADER_KEY_REGION, '')).strip()
+        hotel = str(record.get(HEADER_KEY_HOTELN, '')).strip()
+        category = str(record.get(HEADER_KEY_CATEGORY, '')).strip()
+        if region and hotel and category:
+            hotel_data[region][hotel].add(category)
+    return { region: { hotel: sorted(list(categories)) for hotel, categories in hotels.items() } for region, hotels in hotel_data.items() }
+
+# --- Скомпилированная таблица тарифов ---
+# Строки листа разбираются один раз при загрузке: даты -> ординалы, цены -> int, отель/категория -> нормализованные ключи.
+DATE_FORMAT = "%d.%m.%Y"
+OFFER_STANDARD = 0; OFFER_SPO = 1; OFFER_EBIRD = 2; OFFER_INVALID = 3
+STANDARD_RATE_REMARK = "Стандартный тариф"
+RATE_PRICE_COLUMNS = {
+    'room': HEADER_KEY_ROOM_IDR,
+    'fb_adt': HEADER_KEY_FB_ADT, 'fb_chld': HEADER_KEY_FB_CHLD,
+    'hb_adt': HEADER_KEY_HB_ADT, 'hb_chld': HEADER_KEY_HB_CHLD,
+    'ai_adt': HEADER_KEY_AI_ADT, 'ai_chld': HEADER_KEY_AI_CHLD,
+    'ebed_adt': HEADER_KEY_EBED_ADT, 'ebed_chld': HEADER_KEY_EBED_CHLD,
+    'bfst_chld': HEADER_KEY_BFST_CHLD,
+    'ny_adt': HEADER_KEY_NY_DINNER_ADT, 'ny_chld': HEADER_KEY_NY_DINNER_CHLD,
+}
+RATE_TEXT_COLUMNS = {
+    'remspo': HEADER_KEY_REMSPO, 'rem1': HEADER_KEY_REM1, 'rem2': HEADER_KEY_REM2,
+    'cxl': HEADER_KEY_CXL, 'remnyd': HEADER_KEY_REMNYD,
+}
+# Все колонки целочисленные; текстовые хранят индекс в таблице строк
+# seq - позиция строки в листе: по ней упорядочены группы, при равной цене выигрывает строка выше
+RATE_COLUMNS = ('seq', 'start', 'end', 'offer_kind', 'offer_value', 'hotel', 'category') + tuple(RATE_PRICE_COLUMNS) + tuple(RATE_TEXT_COLUMNS)
+RATE_LOOKUP_CACHE_SIZE = 4096
+RATES_LOADING_MESSAGE = "Тарифы загружаются, попробуйте через минуту."
+
+def parse_sheet_date(value) -> date:
+    return datetime.strptime(str(value), DATE_FORMAT).date()
+
+class RateLookup:
+    # Тарифы одного запроса (отель/категория) с положительной ценой, разбитые на элементарные отрезки дат.
+    # boundaries - отсортированные границы, segments[k] - строки, действующие на [boundaries[k], boundaries[k+1]), в порядке листа.
+    __slots__ = ('rows', 'boundaries', 'segments', 'arrays')
+    def __init__(self, table, row_ids: list):
+        start = table.columns['start']; end = table.columns['end']; room = table.columns['room']
+        self.rows = rows = [row for row in row_ids if room[row] > 0]
+        self.arrays = None  # RateArrays, строятся по требованию векторного движка
+        self.boundaries = sorted({start[row] for row in rows} | {end[row] + 1 for row in rows})
+        segments = [[] for _ in range(max(len(self.boundaries) - 1, 0))]
+        for row in rows:
+            for k in range(bisect_left(self.boundaries, start[row]), bisect_left(self.boundaries, end[row] + 1)):
+                segments[k].append(row)
+        self.segments = [tuple(segment) for segment in segments]
+
+    def candidates(self, day_ordinal: int) -> tuple:
+        k = bisect_right(self.boundaries, day_ordinal) - 1
+        if k < 0 or k >= len(self.segments): return ()
+        return self.segments[k]
+
+    def sweep(self, first_ordinal: int, last_ordinal: int) -> list:
+        # Кандидаты на каждый день диапазона за один проход по отрезкам (без bisect на каждую ночь)
+        boundaries = self.boundaries; segments = self.segments
+        k = bisect_right(boundaries, first_ordinal) - 1; nightly_candidates = []
+        for day_ordinal in range(first_ordinal, last_ordinal + 1):
+            while k + 1 < len(boundaries) and boundaries[k + 1] <= day_ordinal: k += 1
+            nightly_candidates.append(segments[k] if 0 <= k < len(segments) else ())
+        return nightly_candidates
+
+class RateTable:
+    def __init__(self):
+        self.columns = {name: [] for name in RATE_COLUMNS}
+        self.strings = ['']; self._string_ids = {'': 0}
+        self._groups = defaultdict(list)  # (отель, категория) -> номера строк в порядке листа
+        self._lookups = {}
+        self.dead_rows = 0  # строки, удаленные из листа при частичной синхронизации
+
+    @classmethod
+    def from_columns(cls, columns: dict, strings: list):
+        # Таблица поверх готовых колонок (например, memoryview из mmap); строки должны идти в порядке листа
+        table = cls()
+        table.columns = columns; table.strings = strings; table._string_ids = {s: i for i, s in enumerate(strings)}
+        hotel = columns['hotel']; category = columns['category']
+        for row in range(len(hotel)): table._groups[(strings[hotel[row]], strings[category[row]])].append(row)
+        return table
+
+    @classmethod
+    def from_records(cls, all_records: list):
+        table = cls()
+        for position, record in enumerate(all_records): table.add_record(record, position)
+        return table
+
+    def __len__(self) -> int:
+        return len(self.columns['start'])
+
+    def intern(self, s: str) -> int:
+        string_id = self._string_ids.get(s)
+        if string_id is None:
+            string_id = self._string_ids[s] = len(self.strings); self.strings.append(s)
+        return string_id
+
+    def text(self, column: str, row: int) -> str:
+        return self.strings[self.columns[column][row]]
+
+    def add_record(self, record: dict, seq: int) -> int:
+        # Строки без корректного периода в расчете не участвуют, как и раньше
+        period_start_str = str(record.get(HEADER_KEY_START_PERIOD, '')); period_end_str = str(record.get(HEADER_KEY_END_PERIOD, ''))
+        if not period_start_str or not period_end_str: return -1
+        try: start = parse_sheet_date(period_start_str).toordinal(); end = parse_sheet_date(period_end_str).toordinal()
+        except (ValueError, TypeError): return -1
+        offer_kind = OFFER_STANDARD; offer_value = 0
+        spoexp_str = str(record.get(HEADER_KEY_SPOEXP, '')).strip(); ebird_str = str(record.get(HEADER_KEY_EBIRD, '')).strip()
+        if spoexp_str:
+            try: offer_kind = OFFER_SPO; offer_value = parse_sheet_date(spoexp_str).toordinal()
+            except (ValueError, TypeError): offer_kind = OFFER_INVALID
+        elif ebird_str:
+            try: offer_kind = OFFER_EBIRD; offer_value = int(ebird_str)
+            except ValueError: offer_kind = OFFER_INVALID
+        hotel_key = normalize_string(record.get(HEADER_KEY_HOTELN, '')); category_key = normalize_string(record.get(HEADER_KEY_CATEGORY, ''))
+        values = {'seq': seq, 'start': start, 'end': end, 'offer_kind': offer_kind, 'offer_value': offer_value,
+                  'hotel': self.intern(hotel_key), 'category': self.intern(category_key)}
+        for name, header in RATE_PRICE_COLUMNS.items(): values[name] = clean_price_string(str(record.get(header, '')))
+        for name, header in RATE_TEXT_COLUMNS.items(): values[name] = self.intern(str(record.get(header, '')).strip())
+        row = len(self)
+        for name in RATE_COLUMNS: self.columns[name].append(values[name])
+        self._groups[(hotel_key, category_key)].append(row)
+        self._lookups.clear()
+        return row
+
+    def lookup(self, hotel_user: str, category_user: str) -> RateLookup:
+        # Сохраняем прежнюю семантику: введенные отель и категория - подстроки значений из листа
+        key = (hotel_user, category_user)
+        rate_lookup = self._lookups.get(key)
+        if rate_lookup is None:
+            row_ids = sorted((row for (hotel_key, category_key), rows in self._groups.items()
+                              if hotel_user in hotel_key and category_user in category_key for row in rows), key=self.columns['seq'].__getitem__)
+            rate_lookup = RateLookup(self, row_ids)
+            if len(self._lookups) >= RATE_LOOKUP_CACHE_SIZE: self._lookups.clear()
+            self._lookups[key] = rate_lookup
+        return rate_lookup
+
+    def match_count(self, hotel_user: str, category_user: str) -> int:
+        # Сколько строк листа подходит запросу (верхняя оценка размера lookup), без построения индекса по датам
+        return sum(len(rows) for (hotel_key, category_key), rows in self._groups.items() if hotel_user in hotel_key and category_user in category_key)
+
+    def patched(self, removed_rows: list, added_records: list, row_ids: list):
+        # Копия таблицы с изменениями частичной синхронизации: разбираются только добавленные строки.
+        # Текущая таблица не меняется, поэтому запросы, уже работающие со старым снимком, видят согласованные данные.
+        # added_records - пары (позиция в листе, запись); row_ids - номер строки таблицы для каждой позиции листа (-1 для новых),
+        # заполняется номерами добавленных строк.
+        table = RateTable.__new__(RateTable)
+        table.columns = {name: list(column) for name, column in self.columns.items()}
+        table.strings = self.strings; table._string_ids = self._string_ids  # таблица строк только дополняется
+        table._groups = defaultdict(list, {key: list(rows) for key, rows in self._groups.items()})
+        table._lookups = {}; table.dead_rows = self.dead_rows + len(removed_rows)
+        affected_keys = set()
+        for row in removed_rows:
+            key = (self.text('hotel', row), self.text('category', row))
+            table._groups[key].remove(row); affected_keys.add(key)
+        for position, record in added_records:
+            row = table.add_record(record, position); row_ids[position] = row
+            if row >= 0: affected_keys.add((table.text('hotel', row), table.text('category', row)))
+        seq = table.columns['seq']
+        for position, row in enumerate(row_ids):
+            if row >= 0: seq[row] = position
+        for key in affected_keys:
+            if table._groups[key]: table._groups[key].sort(key=seq.__getitem__)
+            else: del table._groups[key]
+        return table
+
+    def first_row_covering(self, hotel_user: str, category_user: str, day: date):
+        # Точное совпадение отеля и категории, первая подходящая строка листа (используется для НГ ужина)
+        start = self.columns['start']; end = self.columns['end']; day_ordinal = day.toordinal()
+        for row in self._groups.get((hotel_user, category_user), ()):
+            if start[row] <= day_ordinal <= end[row]: return row
+        return None
+
+    def offer_remark(self, row: int, checkin_date_obj: date, today: date):
+        # None - спецпредложение недействительно для этого заезда
+        offer_kind = self.columns['offer_kind'][row]; offer_value = self.columns['offer_value'][row]
+        if offer_kind == OFFER_STANDARD: return STANDARD_RATE_REMARK
+        if offer_kind == OFFER_SPO: return self.text('remspo', row) if today.toordinal() <= offer_value else None
+        if offer_kind == OFFER_EBIRD: return f"Применяется EARLY BIRD - {offer_value} дней до заезда" if (checkin_date_obj - today).days >= offer_value else None
+        return None
+
+# --- Кэш листа тарифов (один снимок на процесс) ---
+class RateSheetSnapshot:
+    # Неизменяемый снимок листа: все запросы, пришедшие одновременно, видят одни и те же данные
+    # table_file - файл, из которого через mmap прочитана rate_table (None, если таблица только в памяти)
+    __slots__ = ('rate_table', 'hotel_data', 'regions', 'version', 'fingerprint', 'loaded_at', 'directory_bodies', 'table_file')
+    def __init__(self, rate_table: RateTable, hotel_data: dict, version: int, fingerprint: str, loaded_at: float, table_file: str = None):
+        self.rate_table = rate_table; self.hotel_data = hotel_data; self.regions = sorted(hotel_data.keys())
+        self.version = version; self.fingerprint = fingerprint; self.loaded_at = loaded_at; self.table_file = table_file
+        self.directory_bodies = {}  # район (None - весь справочник) -> (готовый JSON, ETag)
+
+def hotel_directory_body(snapshot: RateSheetSnapshot, region: str = None):
+    # Справочник отелей сериализуется один раз на снимок; None - такого района нет
+    cached = snapshot.directory_bodies.get(region)
+    if cached is None:
+        if region is not None and region not in snapshot.hotel_data: return None
+        data = snapshot.hotel_data if region is None else snapshot.hotel_data[region]
+        body = json.dumps(data, ensure_ascii=False, sort_keys=True).encode('utf-8')
+        cached = snapshot.directory_bodies[region] = (body, hashlib.sha1(body).hexdigest()[:20])
+    return cached
+
+# --- Бинарный снимок таблицы тарифов ---
+# Формат: сигнатура, длина и JSON-заголовок (таблица строк, дерево отелей, состояние синхронизации), затем выровненные
+# int64-колонки RATE_COLUMNS, номера строк таблицы для строк листа (int64) и 8-байтовые хэши строк листа.
+# Колонки читаются через mmap без копирования, поэтому воркеры делят одни и те же страницы через кэш ОС.
+RATE_SNAPSHOT_MAGIC = b'RATETBL1'
+
+def write_rate_snapshot(path: str, rate_table: RateTable, hotel_data: dict, header: list, row_ids: list, row_hashes: list,
+                        fingerprint: str, last_update_time):
+    # В файл попадают только живые строки (в порядке листа), поэтому номера строк переписываются
+    live_rows = [row for row in row_ids if row >= 0]; new_ids = {row: i for i, row in enumerate(live_rows)}
+    meta = json.dumps({'byteorder': sys.byteorder, 'rows': len(live_rows), 'sheet_rows': len(row_ids), 'columns': list(RATE_COLUMNS),
+                       'strings': rate_table.strings, 'hotel_data': hotel_data, 'header': header,
+                       'fingerprint': fingerprint, 'last_update_time': last_update_time}, ensure_ascii=False).encode('utf-8')
+    meta += b' ' * (-(len(RATE_SNAPSHOT_MAGIC) + 4 + len(meta)) % 8)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as snapshot_file:
+        snapshot_file.write(RATE_SNAPSHOT_MAGIC); snapshot_file.write(struct.pack('<I', len(meta))); snapshot_file.write(meta)
+        for name in RATE_COLUMNS:
+            column = rate_table.columns[name]
+            snapshot_file.write(array('q', (column[row] for row in live_rows)).tobytes())
+        snapshot_file.write(array('q', (new_ids.get(row, -1) for row in row_ids)).tobytes())
+        snapshot_file.write(b''.join(row_hashes))
+    os.replace(tmp_path, path)
+
+def read_rate_snapshot(path: str) -> dict:
+    with open(path, 'rb') as snapshot_file:
+        mapped = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+    if mapped[:len(RATE_SNAPSHOT_MAGIC)] != RATE_SNAPSHOT_MAGIC: raise ValueError("неизвестный формат файла")
+    offset = len(RATE_SNAPSHOT_MAGIC); (meta_length,) = struct.unpack_from('<I', mapped, offset); offset += 4
+    meta = json.loads(bytes(mapped[offset:offset + meta_length]).decode('utf-8')); offset += meta_length
+    if meta['byteorder'] != sys.byteorder or meta['columns'] != list(RATE_COLUMNS): raise ValueError("снимок записан в другом формате")
+    view = memoryview(mapped); rows = meta['rows']; sheet_rows = meta['sheet_rows']; columns = {}
+    for name in RATE_COLUMNS:
+        columns[name] = view[offset:offset + rows * 8].cast('q'); offset += rows * 8
+    row_ids = view[offset:offset + sheet_rows * 8].cast('q').tolist(); offset += sheet_rows * 8
+    row_hashes = [bytes(view[offset + i * 8:offset + (i + 1) * 8]) for i in range(sheet_rows)]
+    meta.update(rate_table=RateTable.from_columns(columns, meta['strings']), row_ids=row_ids, row_hashes=row_hashes)
+    return meta
+
+# --- Частичная синхронизация листа ---
+def sheet_row_hash(row: list) -> bytes:
+    return hashlib.sha1('\x1f'.join(map(str, row)).encode('utf-8')).digest()[:8]
+
+def sheet_row_record(header: list, row: list) -> dict:
+    # То же, что строка из worksheet.get_all_records(): значения, похожие на числа, становятся int/float
+    return dict(zip(header, numericise_all(row)))
+
+class RateSheetSync:
+    # Держит хэши строк листа и их соответствие строкам RateTable. Сначала дешево проверяет, менялся ли документ
+    # (lastUpdateTime из Drive), и только тогда скачивает значения; заново разбираются лишь изменившиеся строки.
+    # worksheet_factory может вернуть любой объект с get_all_values() (например, поддельный лист в тестах);
+    # spreadsheet.get_lastUpdateTime() необязателен - без него (или если Drive API недоступен) значения
+    # сравниваются при каждой синхронизации.
+    def __init__(self, worksheet_factory, snapshot_path: str = RATE_SNAPSHOT_FILE):
+        self._worksheet_factory = worksheet_factory; self._worksheet = None
+        self.snapshot_path = snapshot_path
+        self.header = None; self.row_hashes = []; self.row_ids = []; self.last_update_time = None
+        self.rate_table = None; self.hotel_data = None; self.fingerprint = None
+        self.rows_parsed_last_sync = 0
+        self.table_file = None  # файл, из которого прочитана текущая rate_table
+
+    def worksheet(self):
+        # Один авторизованный клиент на процесс; после неустранимой ошибки он пересоздается при следующем обращении
+        if self._worksheet is None:
+            with stage_seconds.time('sheet_auth'): self._worksheet = self._worksheet_factory()
+        return self._worksheet
+
+    def call_sheets(self, operation, stage: str):
+        for attempt in range(SHEETS_MAX_RETRIES + 1):
+            try:
+                worksheet = self.worksheet()
+                with stage_seconds.time(stage): return operation(worksheet)
+            except Exception as e:
+                if not is_retryable_sheets_error(e) or attempt == SHEETS_MAX_RETRIES:
+                    sheets_errors_total.inc(stage, 'fail'); self._worksheet = None; raise
+                sheets_errors_total.inc(stage, 'retry')
+                delay = SHEETS_RETRY_BASE_SECONDS * 2 ** attempt * (0.5 + random.random())
+                logger.warning("Временная ошибка Google Sheets, повтор", extra={'stage': stage, 'error': f"{type(e).__name__}: {e}", 'retry_in_s': round(delay, 1)})
+                time.sleep(delay)
+
+    def remote_update_time(self):
+        def get_update_time(worksheet):
+            get_last_update_time = getattr(getattr(worksheet, 'spreadsheet', None), 'get_lastUpdateTime', None)
+            return get_last_update_time() if get_last_update_time else None
+        # Время изменения отдает Drive API, которого может не быть в проекте (403): тогда просто сравниваем строки.
+        # Временные сбои (сеть, 5xx) пробрасываются: лист тогда тоже недоступен, и повторять скачивание незачем.
+        try: return self.call_sheets(get_update_time, 'sheet_update_check')
+        except Exception as e:
+            if is_retryable_sheets_error(e): raise
+            logger.warning("Не удалось узнать время изменения листа, сравниваем строки", extra={'error': f"{type(e).__name__}: {e}"})
+            return None
+
+    def sync(self) -> bool:
+        # True - таблица тарифов изменилась
+        update_time = self.remote_update_time()
+        if self.rate_table is not None and update_time is not None and update_time == self.last_update_time: return False
+        values = self.call_sheets(lambda worksheet: worksheet.get_all_values(), 'sheet_fetch')
+        with stage_seconds.time('record_parsing'): changed = self.apply_values(values)
+        self.last_update_time = update_time
+        if changed or update_time is not None: self.save_local()
+        return changed
+
+    def apply_values(self, values: list) -> bool:
+        header = [str(key) for key in values[0]] if values else []
+        rows = [list(row[:len(header)]) + [''] * (len(header) - len(row)) for row in values[1:]]
+        row_hashes = [sheet_row_hash(row) for row in rows]
+        if self.rate_table is not None and header == self.header and row_hashes == self.row_hashes: return False
+        if self.rate_table is None or header != self.header or self.rate_table.dead_rows > len(self.rate_table) // 2:
+            # Полная сборка: первый запуск, смена заголовков или накопилось слишком много удаленных строк
+            rate_table = RateTable(); row_ids = [rate_table.add_record(sheet_row_record(header, row), position) for position, row in enumerate(rows)]
+            self.rows_parsed_last_sync = len(rows)
+        else:
+            row_ids = [-1] * len(rows); removed_rows = []; added_records = []
+            for tag, i1, i2, j1, j2 in SequenceMatcher(None, self.row_hashes, row_hashes, autojunk=False).get_opcodes():
+                if tag == 'equal': row_ids[j1:j2] = self.row_ids[i1:i2]; continue
+                removed_rows.extend(row for row in self.row_ids[i1:i2] if row >= 0)
+                added_records.extend((position, sheet_row_record(header, rows[position])) for position in range(j1, j2))
+            rate_table = self.rate_table.patched(removed_rows, added_records, row_ids)
+            self.rows_parsed_last_sync = len(added_records)
+        # Дерево регионов строится по трем колонкам, без разбора дат и цен
+        tree_columns = [(key, header.index(key)) for key in (HEADER_KEY_REGION, HEADER_KEY_HOTELN, HEADER_KEY_CATEGORY) if key in header]
+        self.hotel_data = build_hotel_tree([{key: numericise(row[index]) for key, index in tree_columns} for row in rows])
+        self.header = header; self.row_hashes = row_hashes; self.row_ids = row_ids; self.rate_table = rate_table; self.table_file = None
+        self.fingerprint = hashlib.sha1(b''.join([sheet_row_hash(header)] + row_hashes)).hexdigest()
+        return True
+
+    def load_local(self) -> bool:
+        # Локальный снимок позволяет воркеру начать отвечать, не обращаясь к Google
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path): return False
+        try:
+            with stage_seconds.time('snapshot_load'): saved = read_rate_snapshot(self.snapshot_path)
+        except (OSError, ValueError, KeyError, TypeError, struct.error) as e:
+            logger.warning("Не удалось прочитать локальный снимок тарифов", extra={'path': self.snapshot_path, 'error': f"{type(e).__name__}: {e}"}); return False
+        self.rate_table = saved['rate_table']; self.hotel_data = saved['hotel_data']; self.header = saved['header']
+        self.row_ids = saved['row_ids']; self.row_hashes = saved['row_hashes']
+        self.fingerprint = saved['fingerprint']; self.last_update_time = saved['last_update_time']; self.table_file = self.snapshot_path
+        return True
+
+    def save_local(self):
+        # После записи таблица снова читается из файла: колонки опять лежат в mmap и делят страницы с другими воркерами,
+        # а не остаются копиями в памяти процесса после каждой частичной синхронизации
+        if not self.snapshot_path or self.rate_table is None: return
+        try:
+            write_rate_snapshot(self.snapshot_path, self.rate_table, self.hotel_data, self.header, self.row_ids, self.row_hashes,
+                                self.fingerprint, self.last_update_time)
+            saved = read_rate_snapshot(self.snapshot_path)
+        except (OSError, ValueError, KeyError, TypeError, struct.error) as e:
+            logger.warning("Не удалось сохранить локальный снимок тарифов", extra={'path': self.snapshot_path, 'error': f"{type(e).__name__}: {e}"}); return
+        # Файл общий для воркеров: если его уже заменил другой процесс другой версией, остаемся на своей таблице
+        if saved['fingerprint'] != self.fingerprint: return
+        self.rate_table = saved['rate_table']; self.row_ids = saved['row_ids']; self.row_hashes = saved['row_hashes']
+        self.table_file = self.snapshot_path
+
+class RateSheetCache:
+    def __init__(self, sheet_sync: RateSheetSync, ttl_seconds: int = SHEET_CACHE_TTL_SECONDS, retry_seconds: int = SHEET_CACHE_RETRY_SECONDS):
+        self._sync = sheet_sync; self.ttl_seconds = ttl_seconds; self.retry_seconds = retry_seconds
+        self._snapshot = None; self._version = 0; self._wake = threading.Event()
+        self._refresh_lock = threading.Lock(); self._thread_lock = threading.Lock(); self._inflight_lock = threading.Lock()
+        self._local_lock = threading.Lock(); self._local_attempted = False
+        self._thread = None; self._thread_pid = None; self._inflight = None
+        self.last_error = None; self.last_attempt_at = 0.0
+
+    def _publish(self):
+        self._version += 1
+        self._snapshot = RateSheetSnapshot(self._sync.rate_table, self._sync.hotel_data, self._version, self._sync.fingerprint, time.time(),
+                                           self._sync.table_file)
+
+    def refresh(self) -> bool:
+        # Одновременно идет только одна синхронизация; при ошибке остается последний удачный снимок
+        with self._refresh_lock:
+            self.last_attempt_at = time.time()
+            try:
+                changed = self._sync.sync()
+            except Exception as e:
+                self.last_error = f"{type(e).__name__}: {e}"; sheet_syncs_total.inc('error')
+                logger.error("Ошибка при обновлении листа тарифов из Google Sheets", extra={'error': self.last_error})
+                return False
+            self.last_error = None; sheet_syncs_total.inc('changed' if changed else 'unchanged')
+            if changed: logger.info("Лист тарифов обновлен", extra={'rows_parsed': self._sync.rows_parsed_last_sync, 'rates': len(self._sync.rate_table)})
+            # Если лист не менялся, версия (а с ней и кэш расчетов) остается прежней
+            if changed or self._snapshot is None: self._publish()
+            else: self._snapshot.loaded_at = time.time()
+            return True
+
+    def request_refresh(self) -> Future:
+        # Обновление выполняет фоновый поток; все, кто попросил его одновременно, получают один и тот же Future.
+        # Поток будится только новым запросом: просьбы во время идущего обновления не запускают еще одно следом.
+        with self._inflight_lock:
+            started = self._inflight is None
+            if started: self._inflight = Future()
+            future = self._inflight
+        self._ensure_refresh_thread()
+        if started: self._wake.set()
+        return future
+
+    def get(self):
+        # Обработчики запросов только читают уже загруженный снимок и сами в Google не ходят
+        snapshot = self._snapshot
+        if snapshot is None:
+            # Первый запрос в процессе: сначала локальный снимок (и сразу фоновая синхронизация),
+            # иначе ограниченное ожидание первой фоновой загрузки. _refresh_lock здесь не берется: его держит
+            # фоновый поток на все время скачивания листа. Локальный снимок читается один раз, до первого обновления.
+            with self._local_lock:
+                if not self._local_attempted:
+                    self._local_attempted = True
+                    if self._snapshot is None and self._sync.load_local(): self._publish()
+            if self._snapshot is None and self.last_error is not None:
+                # Лист недоступен: не ждем, а новую попытку просим не чаще раза в retry_seconds
+                if time.time() - self.last_attempt_at >= self.retry_seconds: self.request_refresh()
+            else:
+                future = self.request_refresh()
+                if self._snapshot is None:
+                    try: future.result(timeout=SHEET_INITIAL_LOAD_WAIT_SECONDS)
+                    except FutureTimeoutError: logger.warning("Лист тарифов еще загружается", extra={'waited_s': SHEET_INITIAL_LOAD_WAIT_SECONDS})
+            snapshot = self._snapshot
+        self._ensure_refresh_thread()
+        return snapshot
+
+    def _ensure_refresh_thread(self):
+        # Поток запускается лениво и заново после fork (gunicorn создает воркеры уже после импорта)
+        if self._thread is not None and self._thread_pid == os.getpid(): return
+        with self._thread_lock:
+            if self._thread is not None and self._thread_pid == os.getpid(): return
+            self._thread = threading.Thread(target=self._refresh_loop, name='rate-sheet-refresh', daemon=True)
+            self._thread_pid = os.getpid(); self._thread.start()
+
+    def _refresh_loop(self):
+        while True:
+            delay = self.ttl_seconds if self.last_error is None else min(self.ttl_seconds, self.retry_seconds)
+            self._wake.wait(max(delay, 1)); self._wake.clear()
+            with self._inflight_lock:
+                if self._inflight is None: self._inflight = Future()
+                future = self._inflight
+            try: refreshed = self.refresh()
+            except Exception: refreshed = False; logger.exception("Ошибка в потоке обновления листа тарифов")
+            with self._inflight_lock: self._inflight = None
+            future.set_result(refreshed)
+
+rate_sheet_cache = RateSheetCache(RateSheetSync(open_rate_worksheet))
+
+def get_structured_hotel_data(snapshot=None) -> dict:
+    if snapshot is None: snapshot = rate_sheet_cache.get()
+    if snapshot is None:
+        logger.error("Нет структурированных данных из Google Sheets", extra={'error': rate_sheet_cache.last_error})
         return {}
+    return snapshot.hotel_data
 
 def parse_additional_options(options_str: str) -> dict:
     parsed_data = { 'wants_fb': False, 'wants_hb': False, 'wants_ai': False, 'extra_bed_child_count': 0, 'extra_bed_adult_count': 0, 'wants_sharing_bed': False }
@@ -76,12 +676,201 @@ def parse_additional_options(options_str: str) -> dict:
         if any(keyword in options_lower for keyword in child_keywords): parsed_data['extra_bed_child_count'] = 1
         else: parsed_data['extra_bed_adult_count'] = 1
     if "sharing bed" in options_lower: parsed_data['wants_sharing_bed'] = True
-    print(f"DEBUG_WEB_PARSE: Распарсенные опции: {parsed_data}")
+    if logger.isEnabledFor(logging.DEBUG): logger.debug("Распарсенные опции", extra={'options': parsed_data})
     return parsed_data
 
 # --- Основная функция расчета ---
-def calculate_price_for_web(user_data_dict: dict) -> list:
-    print(f"WEB_CALC: Начинаем расчет. Входные данные: {user_data_dict}")
+# Подписи доплат в детализации; порядок ключей совпадает с порядком начисления за ночь
+SURCHARGE_LABELS = {
+    'meal': "Доплата за питание",
+    'extra_bed_adult': "Доп. кровать (взр)",
+    'extra_bed_child': "Доп. кровать (реб)",
+    'child_breakfast': "Завтрак для ребенка (sharing bed)",
+}
+
+def compute_quote(rate_table: RateTable, hotel_name_user: str, category_user: str, checkin_date_obj: date, num_nights: int,
+                  adults_count: int, children_count: int, parsed_user_options: dict, today: date, nightly_candidates=None) -> dict:
+    # Структурированный расчет без HTML. nightly_candidates - уже найденные кандидаты по ночам (пакетный расчет),
+    # иначе они берутся из индекса таблицы. Время выбора тарифов и время доплат пишутся в метрики одним наблюдением на расчет.
+    rate_columns = rate_table.columns; log_nights = logger.isEnabledFor(logging.DEBUG)
+    quote_started = time.perf_counter()
+    if nightly_candidates is None:
+        rate_lookup = rate_table.lookup(hotel_name_user, category_user)
+        nightly_candidates = [rate_lookup.candidates(checkin_date_obj.toordinal() + i) for i in range(num_nights)]
+    selection_seconds = time.perf_counter() - quote_started
+    nightly = []; total_room_cost_idr = 0; total_surcharges_idr = 0
+    # Словари вместо множеств: ремарки без повторов и в порядке появления
+    general_remarks = {}; policy_remarks = {}; special_offer_remarks = {}; cancellation_policy = {}
+    for i in range(num_nights):
+        night_started = time.perf_counter()
+        current_night_date_obj = checkin_date_obj + timedelta(days=i)
+        rate_for_current_night = None; applicable_row = None; best_remark = None
+        # При равной цене выигрывает строка, стоящая в листе выше
+        for row in nightly_candidates[i]:
+            offer_remark = rate_table.offer_remark(row, checkin_date_obj, today)
+            if offer_remark is None: continue
+            if applicable_row is None or rate_columns['room'][row] < rate_for_current_night:
+                applicable_row = row; rate_for_current_night = rate_columns['room'][row]; best_remark = offer_remark
+        selection_seconds += time.perf_counter() - night_started
+        night = {'date': current_night_date_obj.strftime(DATE_FORMAT), 'room_idr': rate_for_current_night, 'remark': best_remark, 'surcharges': {}, 'surcharges_idr': 0}
+        nightly.append(night)
+        if applicable_row is None: continue
+        if best_remark and best_remark != STANDARD_RATE_REMARK: special_offer_remarks[best_remark] = True
+        if log_nights: logger.debug("Выбран тариф", extra={'night': night['date'], 'room_idr': rate_for_current_night, 'remark': best_remark})
+        total_room_cost_idr += rate_for_current_night
+        surcharges = night['surcharges']; cost = 0
+        if parsed_user_options['wants_fb']: cost = rate_columns['fb_adt'][applicable_row]*adults_count + rate_columns['fb_chld'][applicable_row]*children_count
+        elif parsed_user_options['wants_hb']: cost = rate_columns['hb_adt'][applicable_row]*adults_count + rate_columns['hb_chld'][applicable_row]*children_count
+        elif parsed_user_options['wants_ai']: cost = rate_columns['ai_adt'][applicable_row]*adults_count + rate_columns['ai_chld'][applicable_row]*children_count
+        # Питание входит в сумму при любом знаке, остальные доплаты - только положительные (как и раньше)
+        night_surcharges_idr = cost
+        if cost > 0: surcharges['meal'] = cost
+        if parsed_user_options['extra_bed_adult_count'] > 0:
+            cost = rate_columns['ebed_adt'][applicable_row]*parsed_user_options['extra_bed_adult_count']
+            if cost > 0: surcharges['extra_bed_adult'] = cost; night_surcharges_idr += cost
+        if parsed_user_options['extra_bed_child_count'] > 0:
+            cost = rate_columns['ebed_chld'][applicable_row]*parsed_user_options['extra_bed_child_count']
+            if cost > 0: surcharges['extra_bed_child'] = cost; night_surcharges_idr += cost
+        if parsed_user_options['wants_sharing_bed'] and children_count > 0:
+            cost = rate_columns['bfst_chld'][applicable_row]*children_count
+            if cost > 0: surcharges['child_breakfast'] = cost; night_surcharges_idr += cost
+        night['surcharges_idr'] = night_surcharges_idr; total_surcharges_idr += night_surcharges_idr
+        if children_count > 0:
+            rem2_text = rate_table.text('rem2', applicable_row)
+            if rem2_text: policy_remarks[rem2_text] = True
+        rem1_text = rate_table.text('rem1', applicable_row)
+        if rem1_text: general_remarks[rem1_text] = True
+        cxl_text = rate_table.text('cxl', applicable_row)
+        if cxl_text: cancellation_policy[cxl_text] = True
+    ny_dinner_idr = 0
+    try:
+        new_year_eve_date = date(checkin_date_obj.year, 12, 31)
+        if checkin_date_obj <= new_year_eve_date < checkin_date_obj + timedelta(days=num_nights):
+            ny_dinner_row = rate_table.first_row_covering(hotel_name_user, category_user, new_year_eve_date)
+            if ny_dinner_row is not None:
+                ny_dinner_total_cost = (rate_columns['ny_adt'][ny_dinner_row] * adults_count) + (rate_columns['ny_chld'][ny_dinner_row] * children_count)
+                if ny_dinner_total_cost > 0:
+                    ny_dinner_idr = ny_dinner_total_cost; total_surcharges_idr += ny_dinner_total_cost
+                    ny_remark = rate_table.text('remnyd', ny_dinner_row)
+                    if ny_remark: special_offer_remarks[ny_remark] = True
+    except Exception: logger.exception("Ошибка в блоке новогоднего ужина")
+    stage_seconds.observe(selection_seconds, 'rate_selection')
+    stage_seconds.observe(time.perf_counter() - quote_started - selection_seconds, 'surcharges')
+    return {
+        'checkin_date': checkin_date_obj.strftime(DATE_FORMAT), 'num_nights': num_nights,
+        'adults_count': adults_count, 'children_count': children_count, 'options': parsed_user_options,
+        'nightly': nightly, 'ny_dinner_idr': ny_dinner_idr,
+        'all_nights_found': all(night['room_idr'] is not None for night in nightly),
+        'total_room_cost_idr': total_room_cost_idr, 'total_surcharges_idr': total_surcharges_idr,
+        'grand_total_idr': total_room_cost_idr + total_surcharges_idr,
+        'remarks': {'general': list(general_remarks), 'children_policy': list(policy_remarks),
+                    'special_offers': list(special_offer_remarks), 'cancellation': list(cancellation_policy)},
+    }
+
+def render_quote_lines(quote: dict, hotel_name_input: str, category_input: str, checkin_str: str, checkout_str: str, usd_rate: float) -> list:
+    num_nights = quote['num_nights']
+    calculation_details_temp = [
+        f"<b>Детализация расчета для отеля '{hotel_name_input}', категория '{category_input}':</b>",
+        f"Период: {checkin_str} - {checkout_str} ({num_nights} ночей).",
+        f"Гости: Взрослых - {quote['adults_count']}, Детей - {quote['children_count']}.\n"
+    ]
+    surcharge_details_parts_temp = []
+    for i, night in enumerate(quote['nightly']):
+        if night['room_idr'] is None:
+            calculation_details_temp.append(f"Ночь {i+1} ({night['date']}): <b>ТАРИФ НЕ НАЙДЕН!</b>"); continue
+        calculation_details_temp.append(f"Ночь {i+1} ({night['date']}): {night['room_idr']:,.0f} IDR (номер)")
+        surcharge_details_parts_temp.extend(f"  {SURCHARGE_LABELS[kind]} (ночь {i+1}): {cost:,.0f} IDR" for kind, cost in night['surcharges'].items())
+    if quote['ny_dinner_idr'] > 0: surcharge_details_parts_temp.append(f"  Обязательный Новогодний Ужин (31.12): {quote['ny_dinner_idr']:,.0f} IDR")
+    if not quote['all_nights_found']: calculation_details_temp.append("\n<b>Внимание:</b> Не удалось найти тарифы для всех ночей...")
+    calculation_details_temp.append(f"\n<b>Итого базовая стоимость номера: {quote['total_room_cost_idr']:,.0f} IDR</b>")
+    if surcharge_details_parts_temp:
+        calculation_details_temp.append("\n<b>Дополнительные услуги и доплаты:</b>"); calculation_details_temp.extend(surcharge_details_parts_temp); calculation_details_temp.append(f"<b>Итого доплаты: {quote['total_surcharges_idr']:,.0f} IDR</b>")
+    grand_total_idr = quote['grand_total_idr']
+    remarks = quote['remarks']
+    for title, key in (("Включено в проживание:", 'general'), ("Примечания по размещению детей:", 'children_policy'),
+                       ("Примечания и спецпредложения:", 'special_offers'), ("Условия аннуляции:", 'cancellation')):
+        if remarks[key]:
+            calculation_details_temp.append(f"\n<b>{title}</b>")
+            calculation_details_temp.extend(f"<i>- {remark}</i>" for remark in remarks[key])
+    calculation_details_temp.append(f"\n<b>ОБЩАЯ РАССЧИТАННАЯ СТОИМОСТЬ: {grand_total_idr:,.0f} IDR</b>")
+    if usd_rate > 0 and grand_total_idr > 0:
+        grand_total_usd = grand_total_idr / usd_rate; avg_daily_usd = grand_total_usd / num_nights
+        calculation_details_temp.append("<hr>"); calculation_details_temp.append(f"<b>Стоимость в USD (курс {usd_rate:,.2f}):</b>"); calculation_details_temp.append(f"<b>ИТОГО: ${grand_total_usd:,.2f} USD</b>"); calculation_details_temp.append(f"<b>Средняя стоимость за ночь: ${avg_daily_usd:,.2f} USD</b>")
+    return calculation_details_temp
+
+def count_quote(quote: dict, endpoint: str):
+    missing_nights = sum(1 for night in quote['nightly'] if night['room_idr'] is None)
+    quotes_total.inc(endpoint, 'rate_not_found' if missing_nights else 'ok')
+    if missing_nights: rate_not_found_nights_total.inc(endpoint, amount=missing_nights)
+
+# --- Кэш расчетов ---
+class QuoteCache:
+    # LRU готовых расчетов (compute_quote) с ограничением по числу записей и примерному объему.
+    # Ключ начинается с версии снимка: первый ключ более новой версии сбрасывает все старые записи,
+    # а запросы, еще работающие со старым снимком, кэш не используют и не очищают.
+    def __init__(self, max_entries: int = QUOTE_CACHE_MAX_ENTRIES, max_bytes: int = QUOTE_CACHE_MAX_BYTES):
+        self.max_entries = max_entries; self.max_bytes = max_bytes
+        self._entries = OrderedDict(); self._lock = threading.Lock()
+        self._bytes = 0; self._version = None
+        self.hits = 0; self.misses = 0; self.evictions = 0; self.invalidations = 0
+
+    def _check_version(self, version: int) -> bool:
+        # False - ключ от устаревшего снимка
+        if self._version is not None and version < self._version: return False
+        if version != self._version:
+            if self._entries: self.invalidations += 1
+            self._entries.clear(); self._bytes = 0; self._version = version
+        return True
+
+    def get(self, key: tuple):
+        with self._lock:
+            if not self._check_version(key[0]): self.misses += 1; return None
+            entry = self._entries.get(key)
+            if entry is None: self.misses += 1; return None
+            self._entries.move_to_end(key); self.hits += 1
+            return entry[0]
+
+    def put(self, key: tuple, quote: dict):
+        size = len(repr(quote))  # грубая оценка объема записи
+        if size > self.max_bytes: return
+        with self._lock:
+            if not self._check_version(key[0]): return
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None: self._bytes -= old_entry[1]
+            self._entries[key] = (quote, size); self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size; self.evictions += 1
+
+    def clear(self):
+        with self._lock: self._entries.clear(); self._bytes = 0; self._version = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes, 'max_entries': self.max_entries, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions, 'invalidations': self.invalidations,
+                    'snapshot_version': self._version}
+
+quote_cache = QuoteCache()
+
+def quote_cache_key(snapshot: RateSheetSnapshot, hotel_name_user: str, category_user: str, checkin_date_obj: date, num_nights: int,
+                    adults_count: int, children_count: int, parsed_user_options: dict, today: date) -> tuple:
+    # "Сегодня" входит в ключ: от него зависят SPOEXP и EARLY BIRD
+    return (snapshot.version, hotel_name_user, category_user, checkin_date_obj.toordinal(), num_nights,
+            adults_count, children_count, tuple(sorted(parsed_user_options.items())), today.toordinal())
+
+def cached_compute_quote(snapshot: RateSheetSnapshot, hotel_name_user: str, category_user: str, checkin_date_obj: date, num_nights: int,
+                         adults_count: int, children_count: int, parsed_user_options: dict, today: date) -> dict:
+    cache_key = quote_cache_key(snapshot, hotel_name_user, category_user, checkin_date_obj, num_nights, adults_count, children_count, parsed_user_options, today)
+    quote = quote_cache.get(cache_key)
+    if quote is None:
+        quote = compute_quote(snapshot.rate_table, hotel_name_user, category_user, checkin_date_obj, num_nights,
+                              adults_count, children_count, parsed_user_options, today)
+        quote_cache.put(cache_key, quote)
+    return quote
+
+def calculate_price_for_web(user_data_dict: dict, snapshot=None) -> list:
+    if logger.isEnabledFor(logging.DEBUG): logger.debug("Начинаем расчет", extra={'input': user_data_dict})
     calculation_output_lines = [] 
     try: 
         checkin_str = user_data_dict.get('checkin_date'); checkout_str = user_data_dict.get('checkout_date')
@@ -103,148 +892,252 @@ def calculate_price_for_web(user_data_dict: dict) -> list:
             return calculation_output_lines
         
         parsed_user_options = parse_additional_options(additional_options_str) 
-        gc = gspread.service_account(filename=CREDENTIALS_FILE); spreadsheet = gc.open_by_key(GOOGLE_SHEET_ID)
-        worksheet = spreadsheet.worksheet(GOOGLE_SHEET_TAB_NAME); all_records = worksheet.get_all_records()
-        
-        total_room_cost_idr = 0; total_surcharges_idr = 0
-        calculation_details_temp = [
-            f"<b>Детализация расчета для отеля '{hotel_name_input}', категория '{category_input}':</b>",
-            f"Период: {checkin_str} - {checkout_str} ({num_nights} ночей).",
-            f"Гости: Взрослых - {adults_count}, Детей - {children_count_val_calc}.\n"
-        ]
-        surcharge_details_parts_temp = []; found_rates_for_all_nights = True
-        
-        # --- ИЗМЕНЕНИЕ: Добавлены новые хранилища для ремарок ---
-        policy_remarks_set = set(); special_offer_remarks_set = set()
-        general_remarks_set = set(); cancellation_policy_set = set()
-        
-        today = date.today()
-        
-        for i in range(num_nights):
-            current_night_date_obj = checkin_date_obj + timedelta(days=i) 
-            valid_rates_for_night = [] 
-            for record in all_records:
-                sheet_hotel = normalize_string(record.get(HEADER_KEY_HOTELN, ''))
-                sheet_category = normalize_string(record.get(HEADER_KEY_CATEGORY, ''))
-                if hotel_name_user in sheet_hotel and category_user in sheet_category:
-                    period_start_str = str(record.get(HEADER_KEY_START_PERIOD, '')); period_end_str = str(record.get(HEADER_KEY_END_PERIOD, ''))
-                    if not period_start_str or not period_end_str : continue 
-                    try: 
-                        period_start_date_obj = datetime.strptime(period_start_str, "%d.%m.%Y").date()
-                        period_end_date_obj = datetime.strptime(period_end_str, "%d.%m.%Y").date()
-                        if period_start_date_obj <= current_night_date_obj <= period_end_date_obj:
-                            price = clean_price_string(str(record.get(HEADER_KEY_ROOM_IDR, '')))
-                            if price <= 0: continue 
-                            is_valid_offer = False; offer_remark = "Стандартный тариф"
-                            spoexp_str = str(record.get(HEADER_KEY_SPOEXP, '')).strip(); ebird_str = str(record.get(HEADER_KEY_EBIRD, '')).strip()
-                            if spoexp_str:
-                                try:
-                                    spoexp_date = datetime.strptime(spoexp_str, "%d.%m.%Y").date()
-                                    if today <= spoexp_date: is_valid_offer = True; offer_remark = str(record.get(HEADER_KEY_REMSPO, '')).strip()
-                                except (ValueError, TypeError): is_valid_offer = False 
-                            elif ebird_str: 
-                                try:
-                                    ebird_days = int(ebird_str); days_until_checkin = (checkin_date_obj - today).days
-                                    if days_until_checkin >= ebird_days: is_valid_offer = True; offer_remark = f"Применяется EARLY BIRD - {ebird_days} дней до заезда"
-                                except ValueError: is_valid_offer = False
-                            else: is_valid_offer = True
-                            if is_valid_offer: valid_rates_for_night.append({'price': price, 'record': record, 'remark': offer_remark})
-                    except (ValueError, TypeError): pass
-            rate_for_current_night = None; applicable_record_for_surcharges = None
-            if valid_rates_for_night:
-                best_rate_info = min(valid_rates_for_night, key=lambda x: x['price'])
-                rate_for_current_night = best_rate_info['price']; applicable_record_for_surcharges = best_rate_info['record']
-                if best_rate_info['remark'] and best_rate_info['remark'] != "Стандартный тариф": special_offer_remarks_set.add(best_rate_info['remark'])
-                print(f"    --> ВЫБРАН ТАРИФ на {current_night_date_obj.strftime('%d.%m.%Y')}: {rate_for_current_night} IDR (Тип: '{best_rate_info['remark']}')")
-            if rate_for_current_night is not None:
-                total_room_cost_idr += rate_for_current_night
-                calculation_details_temp.append(f"Ночь {i+1} ({current_night_date_obj.strftime('%d.%m.%Y')}): {rate_for_current_night:,.0f} IDR (номер)")
-                if applicable_record_for_surcharges:
-                    surcharges_for_current_night_this_night = 0; cost = 0 
-                    if parsed_user_options['wants_fb']: cost = (clean_price_string(applicable_record_for_surcharges.get(HEADER_KEY_FB_ADT, '0'))*adults_count + clean_price_string(applicable_record_for_surcharges.get(HEADER_KEY_FB_CHLD, '0'))*children_count_val_calc)
-                    elif parsed_user_options['wants_hb']: cost = (clean_price_string(applicable_record_for_surcharges.get(HEADER_KEY_HB_ADT, '0'))*adults_count + clean_price_string(applicable_record_for_surcharges.get(HEADER_KEY_HB_CHLD, '0'))*children_count_val_calc)
-                    elif parsed_user_options['wants_ai']: cost = (clean_price_string(applicable_record_for_surcharges.get(HEADER_KEY_AI_ADT, '0'))*adults_count + clean_price_string(applicable_record_for_surcharges.get(HEADER_KEY_AI_CHLD, '0'))*children_count_val_calc)
-                    if cost > 0: surcharge_details_parts_temp.append(f"  Доплата за питание (ночь {i+1}): {cost:,.0f} IDR")
-                    surcharges_for_current_night_this_night += cost
-                    if parsed_user_options['extra_bed_adult_count'] > 0:
-                        cost_eb_adt = clean_price_string(applicable_record_for_surcharges.get(HEADER_KEY_EBED_ADT, '0'))*parsed_user_options['extra_bed_adult_count']
-                        if cost_eb_adt > 0: surcharges_for_current_night_this_night += cost_eb_adt; surcharge_details_parts_temp.append(f"  Доп. кровать (взр) (ночь {i+1}): {cost_eb_adt:,.0f} IDR")
-                    if parsed_user_options['extra_bed_child_count'] > 0:
-                        cost_eb_chld = clean_price_string(applicable_record_for_surcharges.get(HEADER_KEY_EBED_CHLD, '0'))*parsed_user_options['extra_bed_child_count']
-                        if cost_eb_chld > 0: surcharges_for_current_night_this_night += cost_eb_chld; surcharge_details_parts_temp.append(f"  Доп. кровать (реб) (ночь {i+1}): {cost_eb_chld:,.0f} IDR")
-                    if parsed_user_options['wants_sharing_bed'] and children_count_val_calc > 0:
-                        cost_bfst_chld = clean_price_string(applicable_record_for_surcharges.get(HEADER_KEY_BFST_CHLD, '0'))*children_count_val_calc
-                        if cost_bfst_chld > 0: surcharges_for_current_night_this_night += cost_bfst_chld; surcharge_details_parts_temp.append(f"  Завтрак для ребенка (sharing bed) (ночь {i+1}): {cost_bfst_chld:,.0f} IDR")
-                total_surcharges_idr += surcharges_for_current_night_this_night
-                if children_count_val_calc > 0 and applicable_record_for_surcharges:
-                    rem2_text = str(applicable_record_for_surcharges.get(HEADER_KEY_REM2, '')).strip()
-                    if rem2_text: policy_remarks_set.add(rem2_text)
-                # --- ИЗМЕНЕНИЕ: Собираем ремарки REM1 и CXL ---
-                if applicable_record_for_surcharges:
-                    rem1_text = str(applicable_record_for_surcharges.get(HEADER_KEY_REM1, '')).strip()
-                    if rem1_text: general_remarks_set.add(rem1_text)
-                    cxl_text = str(applicable_record_for_surcharges.get(HEADER_KEY_CXL, '')).strip()
-                    if cxl_text: cancellation_policy_set.add(cxl_text)
-            else: calculation_details_temp.append(f"Ночь {i+1} ({current_night_date_obj.strftime('%d.%m.%Y')}): <b>ТАРИФ НЕ НАЙДЕН!</b>"); found_rates_for_all_nights = False
-        try:
-            new_year_eve_date = date(checkin_date_obj.year, 12, 31)
-            if checkin_date_obj <= new_year_eve_date < checkout_date_obj:
-                record_for_ny_dinner_lookup = None
-                for rec_ny_check in all_records:
-                    if normalize_string(rec_ny_check.get(HEADER_KEY_HOTELN, '')) == hotel_name_user and normalize_string(rec_ny_check.get(HEADER_KEY_CATEGORY, '')) == category_user:
-                        ny_period_start_str = str(rec_ny_check.get(HEADER_KEY_START_PERIOD, '')); ny_period_end_str = str(rec_ny_check.get(HEADER_KEY_END_PERIOD, ''))
-                        if not ny_period_start_str or not ny_period_end_str: continue
-                        try:
-                            ny_period_start = datetime.strptime(ny_period_start_str, "%d.%m.%Y").date(); ny_period_end = datetime.strptime(ny_period_end_str, "%d.%m.%Y").date()
-                            if ny_period_start <= new_year_eve_date <= ny_period_end: record_for_ny_dinner_lookup = rec_ny_check; break 
-                        except ValueError: continue
-                if record_for_ny_dinner_lookup:
-                    ny_adt_cost_str = record_for_ny_dinner_lookup.get(HEADER_KEY_NY_DINNER_ADT, ''); ny_chld_cost_str = record_for_ny_dinner_lookup.get(HEADER_KEY_NY_DINNER_CHLD, '')
-                    if ny_adt_cost_str or ny_chld_cost_str: 
-                        ny_adt_cost = clean_price_string(ny_adt_cost_str); ny_chld_cost = clean_price_string(ny_chld_cost_str)
-                        ny_dinner_total_cost = (ny_adt_cost * adults_count) + (ny_chld_cost * children_count_val_calc)
-                        if ny_dinner_total_cost > 0:
-                            total_surcharges_idr += ny_dinner_total_cost; surcharge_details_parts_temp.append(f"  Обязательный Новогодний Ужин (31.12): {ny_dinner_total_cost:,.0f} IDR")
-                            ny_remark = str(record_for_ny_dinner_lookup.get(HEADER_KEY_REMNYD, '')).strip()
-                            if ny_remark: special_offer_remarks_set.add(ny_remark)
-        except Exception as e_nyd: print(f"!!! ОШИБКА В БЛОКЕ НГ УЖИНА: {type(e_nyd).__name__} - {e_nyd}"); print(traceback.format_exc())
-        if not found_rates_for_all_nights: calculation_details_temp.append("\n<b>Внимание:</b> Не удалось найти тарифы для всех ночей...")
-        calculation_details_temp.append(f"\n<b>Итого базовая стоимость номера: {total_room_cost_idr:,.0f} IDR</b>")
-        if surcharge_details_parts_temp:
-            calculation_details_temp.append("\n<b>Дополнительные услуги и доплаты:</b>"); calculation_details_temp.extend(surcharge_details_parts_temp); calculation_details_temp.append(f"<b>Итого доплаты: {total_surcharges_idr:,.0f} IDR</b>")
-        grand_total_idr = total_room_cost_idr + total_surcharges_idr
-        
-        # --- ИЗМЕНЕНИЕ: Вывод новых ремарок ---
-        if general_remarks_set: 
-            calculation_details_temp.append("\n<b>Включено в проживание:</b>")
-            calculation_details_temp.extend(f"<i>- {remark}</i>" for remark in general_remarks_set)
-        if policy_remarks_set: 
-            calculation_details_temp.append("\n<b>Примечания по размещению детей:</b>")
-            calculation_details_temp.extend(f"<i>- {remark}</i>" for remark in policy_remarks_set)
-        if special_offer_remarks_set: 
-            calculation_details_temp.append("\n<b>Примечания и спецпредложения:</b>")
-            calculation_details_temp.extend(f"<i>- {remark}</i>" for remark in special_offer_remarks_set)
-        if cancellation_policy_set:
-            calculation_details_temp.append("\n<b>Условия аннуляции:</b>")
-            calculation_details_temp.extend(f"<i>- {remark}</i>" for remark in cancellation_policy_set)
-            
-        calculation_details_temp.append(f"\n<b>ОБЩАЯ РАССЧИТАННАЯ СТОИМОСТЬ: {grand_total_idr:,.0f} IDR</b>")
-        if usd_rate > 0 and grand_total_idr > 0:
-            grand_total_usd = grand_total_idr / usd_rate; avg_daily_usd = grand_total_usd / num_nights
-            calculation_details_temp.append("<hr>"); calculation_details_temp.append(f"<b>Стоимость в USD (курс {usd_rate:,.2f}):</b>"); calculation_details_temp.append(f"<b>ИТОГО: ${grand_total_usd:,.2f} USD</b>"); calculation_details_temp.append(f"<b>Средняя стоимость за ночь: ${avg_daily_usd:,.2f} USD</b>")
-        calculation_output_lines.extend(calculation_details_temp)
+        if snapshot is None: snapshot = rate_sheet_cache.get()
+        if snapshot is None:
+            # Ожидаемое состояние холодного воркера, а не ошибка расчета
+            calculation_output_lines.append(f"<b>{RATES_LOADING_MESSAGE}</b>")
+            return calculation_output_lines
+        quote = cached_compute_quote(snapshot, hotel_name_user, category_user, checkin_date_obj, num_nights,
+                                     adults_count, children_count_val_calc, parsed_user_options, date.today())
+        count_quote(quote, 'web')
+        calculation_output_lines.extend(render_quote_lines(quote, hotel_name_input, category_input, checkin_str, checkout_str, usd_rate))
     except Exception as e_outer: 
-        calculation_output_lines.append(f"<b>Произошла непредвиденная критическая ошибка ({type(e_outer).__name__}).</b>"); print(f"Критическая внешняя ошибка: {type(e_outer).__name__} - {e_outer}"); print(traceback.format_exc())
+        calculation_output_lines.append(f"<b>Произошла непредвиденная критическая ошибка ({type(e_outer).__name__}).</b>"); logger.exception("Критическая ошибка расчета")
     return calculation_output_lines
 
+# --- Пакетный расчет ---
+def parse_request_date(value) -> date:
+    # В API принимаем и формат листа (дд.мм.гггг), и формат input type=date (гггг-мм-дд)
+    value = str(value or '').strip()
+    for date_format in (DATE_FORMAT, '%Y-%m-%d'):
+        try: return datetime.strptime(value, date_format).date()
+        except ValueError: pass
+    raise ValueError(f"Неверная дата: '{value}'")
+
+def parse_quote_request(item: dict) -> dict:
+    if not isinstance(item, dict): raise ValueError("Запрос должен быть объектом")
+    hotel_name_user = normalize_string(item.get('hotel', '') or ''); category_user = normalize_string(item.get('category', '') or '')
+    if not hotel_name_user or not category_user: raise ValueError("Не указан отель или категория")
+    try: adults_count = int(item.get('adults_count', 0)); children_count = int(item.get('children_count', 0) or 0)
+    except (ValueError, TypeError): raise ValueError("Количество гостей должно быть числом")
+    if adults_count <= 0 or children_count < 0: raise ValueError("Количество взрослых должно быть положительным, детей - 0 или больше")
+    checkin_date_obj = parse_request_date(item.get('checkin_date')); checkout_date_obj = parse_request_date(item.get('checkout_date'))
+    num_nights = (checkout_date_obj - checkin_date_obj).days
+    if num_nights <= 0: raise ValueError("Дата выезда должна быть позже даты заезда")
+    if num_nights > BATCH_MAX_NIGHTS: raise ValueError(f"Слишком длинный период (больше {BATCH_MAX_NIGHTS} ночей)")
+    try: usd_rate = float(str(item.get('usd_rate', '0') or '0').replace(',', '.'))
+    except ValueError: usd_rate = 0.0
+    return {'hotel_user': hotel_name_user, 'category_user': category_user, 'checkin': checkin_date_obj, 'num_nights': num_nights,
+            'adults_count': adults_count, 'children_count': children_count, 'usd_rate': usd_rate,
+            'options': parse_additional_options(str(item.get('additional_options', '') or ''))}
+
+BATCH_TOO_LARGE_MESSAGE = f"Слишком много расчетов в одном запросе (максимум {BATCH_MAX_QUOTES})"
+
+class BatchTooLargeError(ValueError):
+    pass
+
+def expand_quote_matrix(spec: dict) -> list:
+    # Декартово произведение отели x категории x периоды с общими параметрами гостей
+    if not isinstance(spec, dict): raise ValueError("matrix должен быть объектом")
+    common = {key: spec[key] for key in ('adults_count', 'children_count', 'additional_options', 'usd_rate') if key in spec}
+    hotels = spec.get('hotels') or []; categories = spec.get('categories') or []; stays = spec.get('stays') or []
+    if not all(isinstance(values, list) for values in (hotels, categories, stays)): raise ValueError("hotels, categories и stays должны быть списками")
+    # Размер проверяется до построения запросов: огромная матрица не должна успеть занять память
+    if len(hotels) * len(categories) * len(stays) > BATCH_MAX_QUOTES: raise BatchTooLargeError(BATCH_TOO_LARGE_MESSAGE)
+    return [dict(common, hotel=hotel, category=category, checkin_date=stay.get('checkin_date'), checkout_date=stay.get('checkout_date'))
+            for hotel in hotels for category in categories for stay in stays if isinstance(stay, dict)]
+
+def cluster_stays(misses: list) -> list:
+    # Разбивает проживания на кластеры близких дат: [первый день, последний день, проживания].
+    # Так проход по датам не растягивается на годы между далекими заездами.
+    clusters = []
+    for miss in sorted(misses, key=lambda miss: miss[1]['checkin']):
+        first_ordinal = miss[1]['checkin'].toordinal(); last_ordinal = first_ordinal + miss[1]['num_nights'] - 1
+        if clusters and first_ordinal <= clusters[-1][1] + BATCH_SWEEP_MAX_GAP_DAYS:
+            clusters[-1][1] = max(clusters[-1][1], last_ordinal); clusters[-1][2].append(miss)
+        else: clusters.append([first_ordinal, last_ordinal, [miss]])
+    return clusters
+
+def price_group(rate_table: RateTable, group_key: tuple, parsed_requests: list, today: date) -> list:
+    # Расчеты одной пары отель/категория: индекс ищется один раз, кандидаты по дням - один проход на кластер близких дат
+    rate_lookup = rate_table.lookup(*group_key); quotes = [None] * len(parsed_requests)
+    for first_ordinal, last_ordinal, cluster in cluster_stays(list(enumerate(parsed_requests))):
+        nightly_candidates = rate_lookup.sweep(first_ordinal, last_ordinal)
+        for position, parsed in cluster:
+            offset = parsed['checkin'].toordinal() - first_ordinal
+            quotes[position] = compute_quote(rate_table, parsed['hotel_user'], parsed['category_user'], parsed['checkin'], parsed['num_nights'],
+                                             parsed['adults_count'], parsed['children_count'], parsed['options'], today,
+                                             nightly_candidates[offset:offset + parsed['num_nights']])
+    return quotes
+
+# --- Пул процессов для крупных пакетов ---
+# Процессы пула сами открывают файл снимка через mmap (страницы общие с воркерами), поэтому таблица не передается.
+# Метрики этапов compute_quote в процессах пула остаются там и в /metrics воркера не попадают.
+_batch_executor = None; _batch_executor_pid = None; _batch_executor_lock = threading.Lock()
+_pool_tables = {}  # в процессе пула: путь файла снимка -> (fingerprint, RateTable)
+
+def get_batch_executor() -> ProcessPoolExecutor:
+    # Пул создается лениво и заново после fork; spawn - потому что в воркере уже работают потоки
+    global _batch_executor, _batch_executor_pid
+    with _batch_executor_lock:
+        if _batch_executor is None or _batch_executor_pid != os.getpid():
+            _batch_executor = ProcessPoolExecutor(max_workers=BATCH_MAX_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+            _batch_executor_pid = os.getpid()
+        return _batch_executor
+
+def price_groups_in_process(table_file: str, fingerprint: str, groups: list, today: date):
+    # Выполняется в процессе пула. None - файл уже заменен снимком другой версии
+    cached = _pool_tables.get(table_file)
+    if cached is None or cached[0] != fingerprint:
+        saved = read_rate_snapshot(table_file)
+        if saved['fingerprint'] != fingerprint: return None
+        cached = _pool_tables[table_file] = (fingerprint, saved['rate_table'])
+    return [price_group(cached[1], group_key, parsed_requests, today) for group_key, parsed_requests in groups]
+
+def price_groups_in_pool(snapshot: RateSheetSnapshot, groups: list, today: date):
+    # Группы делятся на непрерывные куски примерно поровну по числу расчетов, по нескольку на процесс.
+    # None - посчитать в этом процессе не удалось (пул сломан или файл снимка сменился)
+    global _batch_executor
+    target = sum(len(parsed_requests) for _, parsed_requests in groups) / (BATCH_MAX_WORKERS * 2)
+    chunks = [[]]; chunk_size = 0
+    for group in groups:
+        if chunk_size >= target: chunks.append([]); chunk_size = 0
+        chunks[-1].append(group); chunk_size += len(group[1])
+    try:
+        executor = get_batch_executor()
+        futures = [executor.submit(price_groups_in_process, snapshot.table_file, snapshot.fingerprint, chunk, today) for chunk in chunks]
+        with stage_seconds.time('batch_pool'): chunk_results = [future.result() for future in futures]
+    except (OSError, ValueError, KeyError, struct.error, BrokenProcessPool) as e:
+        with _batch_executor_lock:
+            if isinstance(e, BrokenProcessPool): _batch_executor = None
+        logger.warning("Пул процессов недоступен, пакет считается в воркере", extra={'error': f"{type(e).__name__}: {e}"})
+        return None
+    if any(group_quotes is None for group_quotes in chunk_results): return None
+    return [quotes for group_quotes in chunk_results for quotes in group_quotes]
+
+def quote_batch(quote_requests: list, snapshot: RateSheetSnapshot, today: date = None) -> list:
+    # Все запросы считаются по одному снимку и группируются по отелю/категории. Сначала кэш; промахи крупного пакета
+    # (от BATCH_PROCESS_MIN_QUOTES) считаются в пуле процессов, если таблица читается из файла снимка, иначе здесь же.
+    today = today or date.today()
+    results = [None] * len(quote_requests); groups = defaultdict(list)
+    for index, item in enumerate(quote_requests):
+        try: parsed = parse_quote_request(item)
+        except ValueError as e: results[index] = {'request': item, 'error': str(e)}; continue
+        groups[(parsed['hotel_user'], parsed['category_user'])].append((index, parsed))
+
+    priced = []; misses = defaultdict(list)  # misses: пара отель/категория -> [(номер запроса, запрос, ключ кэша)]
+    for group_key, group in groups.items():
+        for index, parsed in group:
+            cache_key = quote_cache_key(snapshot, parsed['hotel_user'], parsed['category_user'], parsed['checkin'], parsed['num_nights'],
+                                        parsed['adults_count'], parsed['children_count'], parsed['options'], today)
+            quote = quote_cache.get(cache_key)
+            if quote is None: misses[group_key].append((index, parsed, cache_key))
+            else: priced.append((index, parsed, quote))
+    miss_groups = [(group_key, [parsed for _, parsed, _ in group_misses]) for group_key, group_misses in misses.items()]
+    group_quotes = None
+    if (snapshot.table_file and BATCH_MAX_WORKERS > 1
+            and sum(len(group_misses) for group_misses in misses.values()) >= BATCH_PROCESS_MIN_QUOTES):
+        group_quotes = price_groups_in_pool(snapshot, miss_groups, today)
+    if group_quotes is None:
+        group_quotes = [price_group(snapshot.rate_table, group_key, parsed_requests, today) for group_key, parsed_requests in miss_groups]
+    for group_misses, quotes in zip(misses.values(), group_quotes):
+        for (index, parsed, cache_key), quote in zip(group_misses, quotes):
+            quote_cache.put(cache_key, quote); priced.append((index, parsed, quote))
+
+    for index, parsed, quote in priced:
+        if parsed['usd_rate'] > 0 and quote['grand_total_idr'] > 0:
+            # Копия: сам расчет лежит в кэше и от курса не зависит
+            quote = dict(quote, grand_total_usd=round(quote['grand_total_idr'] / parsed['usd_rate'], 2))
+        results[index] = {'request': quote_requests[index], 'quote': quote}; count_quote(quote, 'batch')
+    return results
+
+# --- Векторный расчет (NumPy) ---
+class RateArrays:
+    # Те же тарифы, что в RateLookup, но колонками NumPy: одна позиция = один тариф, порядок листа сохранен
+    def __init__(self, rate_table: RateTable, rows: list):
+        def column(name): return np.fromiter((rate_table.columns[name][row] for row in rows), dtype=np.int64, count=len(rows))
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.start = column('start'); self.end = column('end'); self.room = column('room')
+        self.offer_kind = column('offer_kind'); self.offer_value = column('offer_value')
+        self.surcharges = {name: column(name) for name in RATE_PRICE_COLUMNS if name != 'room'}
+
+    def min_checkin(self, today: date):
+        # Тариф действует для заезда c, если c >= min_checkin (EARLY BIRD), SPO и стандарт от даты заезда не зависят
+        never = np.iinfo(np.int64).max; always = np.iinfo(np.int64).min
+        min_checkin = np.full(len(self.room), never, dtype=np.int64)
+        min_checkin[self.offer_kind == OFFER_STANDARD] = always
+        min_checkin[(self.offer_kind == OFFER_SPO) & (self.offer_value >= today.toordinal())] = always
+        ebird = self.offer_kind == OFFER_EBIRD
+        min_checkin[ebird] = today.toordinal() + self.offer_value[ebird]
+        return min_checkin
+
+    def night_surcharges(self, adults_count: int, children_count: int, parsed_user_options: dict):
+        # Доплата за ночь для каждого тарифа по тем же правилам, что и в compute_quote()
+        surcharges = self.surcharges
+        if parsed_user_options['wants_fb']: total = surcharges['fb_adt']*adults_count + surcharges['fb_chld']*children_count
+        elif parsed_user_options['wants_hb']: total = surcharges['hb_adt']*adults_count + surcharges['hb_chld']*children_count
+        elif parsed_user_options['wants_ai']: total = surcharges['ai_adt']*adults_count + surcharges['ai_chld']*children_count
+        else: total = np.zeros(len(self.room), dtype=np.int64)
+        extras = []
+        if parsed_user_options['extra_bed_adult_count'] > 0: extras.append(surcharges['ebed_adt']*parsed_user_options['extra_bed_adult_count'])
+        if parsed_user_options['extra_bed_child_count'] > 0: extras.append(surcharges['ebed_chld']*parsed_user_options['extra_bed_child_count'])
+        if parsed_user_options['wants_sharing_bed'] and children_count > 0: extras.append(surcharges['bfst_chld']*children_count)
+        for extra in extras: total = total + np.where(extra > 0, extra, 0)
+        return total
+
+def get_rate_arrays(rate_table: RateTable, hotel_name_user: str, category_user: str) -> RateArrays:
+    rate_lookup = rate_table.lookup(hotel_name_user, category_user)
+    if rate_lookup.arrays is None: rate_lookup.arrays = RateArrays(rate_table, rate_lookup.rows)
+    return rate_lookup.arrays
+
+def price_calendar(rate_table: RateTable, hotel_name_user: str, category_user: str, first_checkin: date, days: int, num_nights: int,
+                   adults_count: int, children_count: int, parsed_user_options: dict, today: date) -> dict:
+    # Итоги для каждой даты заезда first_checkin + d (d < days) при проживании num_nights ночей.
+    # Для каждой ночи берется самый дешевый действующий тариф (argmin отдает первую строку листа при равенстве цен).
+    arrays = get_rate_arrays(rate_table, hotel_name_user, category_user)
+    checkins = first_checkin.toordinal() + np.arange(days, dtype=np.int64)
+    room_totals = np.zeros(days, dtype=np.int64); surcharge_totals = np.zeros(days, dtype=np.int64)
+    nights_found = np.zeros(days, dtype=np.int64)
+    if len(arrays.room):
+        min_checkin = arrays.min_checkin(today)
+        night_surcharges = arrays.night_surcharges(adults_count, children_count, parsed_user_options)
+        offsets = np.arange(num_nights, dtype=np.int64)
+        chunk = max(1, CALENDAR_CHUNK_CELLS // (len(arrays.room) * num_nights))
+        for lo in range(0, days, chunk):
+            block = checkins[lo:lo + chunk]
+            nights = block[:, None] + offsets[None, :]  # даты x ночи
+            valid = ((arrays.start[:, None, None] <= nights[None]) & (nights[None] <= arrays.end[:, None, None])
+                     & (block[None, :, None] >= min_checkin[:, None, None]))
+            prices = np.where(valid, arrays.room[:, None, None], np.iinfo(np.int64).max)
+            best = prices.argmin(axis=0); found = valid.any(axis=0)
+            room_totals[lo:lo + chunk] = np.where(found, arrays.room[best], 0).sum(axis=1)
+            surcharge_totals[lo:lo + chunk] = np.where(found, night_surcharges[best], 0).sum(axis=1)
+            nights_found[lo:lo + chunk] = found.sum(axis=1)
+    # Новогодний ужин: по строке с точным совпадением отеля и категории, если 31.12 года заезда попадает в проживание
+    years = np.array([date.fromordinal(int(ordinal)).year for ordinal in checkins], dtype=np.int64)
+    for year in np.unique(years):
+        new_year_eve_date = date(int(year), 12, 31)
+        ny_dinner_row = rate_table.first_row_covering(hotel_name_user, category_user, new_year_eve_date)
+        if ny_dinner_row is None: continue
+        ny_dinner_total_cost = rate_table.columns['ny_adt'][ny_dinner_row]*adults_count + rate_table.columns['ny_chld'][ny_dinner_row]*children_count
+        if ny_dinner_total_cost <= 0: continue
+        covers = (years == year) & (checkins <= new_year_eve_date.toordinal()) & (new_year_eve_date.toordinal() < checkins + num_nights)
+        surcharge_totals[covers] += ny_dinner_total_cost
+    return {'checkins': checkins, 'total_room_cost_idr': room_totals, 'total_surcharges_idr': surcharge_totals,
+            'grand_total_idr': room_totals + surcharge_totals, 'all_nights_found': nights_found == num_nights}
+
 # --- Flask-приложение ---
 app = Flask(__name__)
 
+def render_index(**context) -> str:
+    with stage_seconds.time('template_render'): return render_template('index.html', **context)
+
 @app.route('/')
 def index():
-    hotel_data = get_structured_hotel_data()
-    regions = sorted(hotel_data.keys())
-    return render_template('index.html', regions=regions, all_hotel_data=hotel_data, user_input=None)
+    # Страница несет только список районов; отели и категории подгружаются из /api/hotels/<район>
+    snapshot = rate_sheet_cache.get()
+    regions = snapshot.regions if snapshot else []
+    return render_index(regions=regions, user_input=None)
 
 @app.route('/calculate_price', methods=['POST'])
 def handle_calculation():
@@ -268,14 +1161,108 @@ def handle_calculation():
                     if not temp_children_count.isdigit() or int(temp_children_count) < 0: error_msg_form = "Количество детей должно быть числом (0 или больше)."
                     else: user_data_from_form['children_count'] = int(temp_children_count)
         except ValueError: error_msg_form = "Ошибка в формате дат или количества гостей."
-        hotel_data = get_structured_hotel_data()
-        regions = sorted(hotel_data.keys())
-        if error_msg_form: return render_template('index.html', error_message=error_msg_form, regions=regions, all_hotel_data=hotel_data)
-        calculation_result_html_list = calculate_price_for_web(user_data_from_form)
+        snapshot = rate_sheet_cache.get()
+        regions = snapshot.regions if snapshot else []
+        if error_msg_form: return render_index(error_message=error_msg_form, regions=regions)
+        # calculate_price_for_web() с snapshot=None снова пошел бы ждать лист, поэтому без снимка сразу отвечаем сами
+        if snapshot is None: return render_index(error_message=RATES_LOADING_MESSAGE, user_input=user_data_from_form, regions=regions)
+        calculation_result_html_list = calculate_price_for_web(user_data_from_form, snapshot)
         result_html_string = "<br>".join(calculation_result_html_list) 
-        return render_template('index.html', calculation_result_html=result_html_string, user_input=user_data_from_form, regions=regions, all_hotel_data=hotel_data)
+        return render_index(calculation_result_html=result_html_string, user_input=user_data_from_form, regions=regions)
     return "This route only accepts POST requests."
 
+@app.route('/api/hotels')
+@app.route('/api/hotels/<path:region>')
+def api_hotels(region=None):
+    # Справочник район -> отель -> категории (или отели одного района) с ETag: повторный запрос без изменений получает 304
+    snapshot = rate_sheet_cache.get()
+    if snapshot is None: return jsonify(error="Лист тарифов недоступен"), 503
+    directory = hotel_directory_body(snapshot, region)
+    if directory is None: return jsonify(error="Район не найден"), 404
+    body, etag = directory
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(etag); response.cache_control.public = True; response.cache_control.max_age = SHEET_CACHE_TTL_SECONDS
+    return response.make_conditional(request)
+
+@app.route('/api/quotes', methods=['POST'])
+def api_quotes():
+    # Тело: {"quotes": [{hotel, category, checkin_date, checkout_date, adults_count, children_count, additional_options, usd_rate}, ...]}
+    # или {"matrix": {hotels: [...], categories: [...], stays: [{checkin_date, checkout_date}], adults_count, ...}}
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict): return jsonify(error="Ожидается JSON-объект"), 400
+    try: quote_requests = expand_quote_matrix(payload['matrix']) if 'matrix' in payload else payload.get('quotes')
+    except BatchTooLargeError as e: return jsonify(error=str(e)), 413
+    except ValueError as e: return jsonify(error=str(e)), 400
+    if not isinstance(quote_requests, list) or not quote_requests: return jsonify(error="Нужен непустой список quotes или matrix"), 400
+    if len(quote_requests) > BATCH_MAX_QUOTES: return jsonify(error=BATCH_TOO_LARGE_MESSAGE), 413
+    snapshot = rate_sheet_cache.get()
+    if snapshot is None: return jsonify(error="Лист тарифов недоступен"), 503
+    return jsonify(snapshot_version=snapshot.version, results=quote_batch(quote_requests, snapshot))
+
+@app.route('/api/cache_stats')
+def api_cache_stats():
+    snapshot = rate_sheet_cache._snapshot
+    return jsonify(quote_cache=quote_cache.stats(), rate_sheet={
+        'snapshot_version': snapshot.version if snapshot else None, 'loaded_at': snapshot.loaded_at if snapshot else None,
+        'rows': len(snapshot.rate_table) if snapshot else 0, 'last_error': rate_sheet_cache.last_error})
+
+@app.route('/metrics')
+def metrics():
+    # Метрики процесса в текстовом формате Prometheus: этапы, счетчики, состояние кэша расчетов и снимка тарифов
+    lines = []
+    for metric in METRICS: lines.extend(metric.exposition())
+    def sample(name, kind, documentation, value):
+        lines.extend((f"# HELP {name} {documentation}", f"# TYPE {name} {kind}", f"{name} {format_metric_value(value)}"))
+    cache_stats = quote_cache.stats()
+    sample('hotel_calculator_quote_cache_entries', 'gauge', "Записей в кэше расчетов", cache_stats['entries'])
+    sample('hotel_calculator_quote_cache_bytes', 'gauge', "Примерный объем кэша расчетов", cache_stats['bytes'])
+    for key in ('hits', 'misses', 'evictions', 'invalidations'):
+        sample(f'hotel_calculator_quote_cache_{key}_total', 'counter', f"Кэш расчетов: {key}", cache_stats[key])
+    snapshot = rate_sheet_cache._snapshot
+    sample('hotel_calculator_rate_snapshot_version', 'gauge', "Версия снимка листа тарифов в процессе", snapshot.version if snapshot else 0)
+    sample('hotel_calculator_rate_snapshot_rates', 'gauge', "Тарифов в снимке", len(snapshot.rate_table) if snapshot else 0)
+    sample('hotel_calculator_rate_snapshot_age_seconds', 'gauge', "Сколько секунд назад снимок сверялся с листом",
+           time.time() - snapshot.loaded_at if snapshot else 0)
+    sample('hotel_calculator_rate_sheet_up', 'gauge', "1 - последняя синхронизация листа прошла без ошибок", 1 if rate_sheet_cache.last_error is None else 0)
+    return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/calendar')
+def api_calendar():
+    # Цена проживания на nights ночей для каждой даты заезда начиная с start (по умолчанию сегодня) на days дней вперед
+    if np is None: return jsonify(error="Календарь недоступен: не установлен numpy"), 501
+    args = request.args
+    hotel_name_user = normalize_string(args.get('hotel', '')); category_user = normalize_string(args.get('category', ''))
+    if not hotel_name_user or not category_user: return jsonify(error="Не указан отель или категория"), 400
+    try:
+        first_checkin = parse_request_date(args['start']) if args.get('start') else date.today()
+        days = int(args.get('days', 365)); num_nights = int(args.get('nights', 1))
+        adults_count = int(args.get('adults_count', 2)); children_count = int(args.get('children_count', 0))
+    except ValueError as e: return jsonify(error=str(e)), 400
+    if not 0 < days <= CALENDAR_MAX_DAYS or not 0 < num_nights <= BATCH_MAX_NIGHTS or adults_count <= 0 or children_count < 0:
+        return jsonify(error="Недопустимые параметры календаря"), 400
+    if first_checkin.toordinal() + days - 1 + num_nights > date.max.toordinal(): return jsonify(error="Период календаря выходит за допустимые даты"), 400
+    snapshot = rate_sheet_cache.get()
+    if snapshot is None: return jsonify(error="Лист тарифов недоступен"), 503
+    rate_count = snapshot.rate_table.match_count(hotel_name_user, category_user)
+    if rate_count * days * num_nights > CALENDAR_MAX_CELLS:
+        return jsonify(error=f"Слишком большой календарь: {rate_count} тарифов x {days} дат x {num_nights} ночей, уменьшите days или nights"), 400
+    with stage_seconds.time('calendar'):
+        calendar = price_calendar(snapshot.rate_table, hotel_name_user, category_user, first_checkin, days, num_nights, adults_count, children_count,
+                                  parse_additional_options(args.get('additional_options', '')), date.today())
+    return jsonify(snapshot_version=snapshot.version, nights=num_nights, calendar=[
+        {'checkin_date': date.fromordinal(int(checkin)).strftime(DATE_FORMAT),
+         'checkout_date': date.fromordinal(int(checkin) + num_nights).strftime(DATE_FORMAT),
+         'total_room_cost_idr': int(room), 'total_surcharges_idr': int(surcharges), 'grand_total_idr': int(room + surcharges), 'all_nights_found': bool(found)}
+        for checkin, room, surcharges, found in zip(calendar['checkins'], calendar['total_room_cost_idr'], calendar['total_surcharges_idr'], calendar['all_nights_found'])])
+
+@app.cli.command('build-rate-snapshot')
+@click.option('--output', default=RATE_SNAPSHOT_FILE, show_default=True, help="Куда записать бинарный снимок")
+def build_rate_snapshot_command(output):
+    """Скачивает лист тарифов и записывает бинарный снимок для быстрого старта воркеров."""
+    sheet_sync = RateSheetSync(open_rate_worksheet, snapshot_path=output)
+    sheet_sync.sync()  # первая загрузка всегда меняет таблицу, поэтому sync() сам записывает снимок
+    click.echo(f"Снимок записан в {output}: {len(sheet_sync.row_ids)} строк листа, {len(sheet_sync.rate_table)} тарифов")
+
 # --- Запуск Flask-приложения ---
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+# Частичная синхронизация листа (RateSheetSync) на поддельном листе без обращения к Google
+import random
+from datetime import date, timedelta
+
+from gspread.exceptions import APIError
+
+import form
+from bench import FakeWorksheet
+
+HEADER = [form.HEADER_KEY_REGION, form.HEADER_KEY_HOTELN, form.HEADER_KEY_CATEGORY, form.HEADER_KEY_START_PERIOD,
+          form.HEADER_KEY_END_PERIOD, form.HEADER_KEY_ROOM_IDR, form.HEADER_KEY_HB_ADT, form.HEADER_KEY_SPOEXP,
+          form.HEADER_KEY_REMSPO, form.HEADER_KEY_EBIRD, form.HEADER_KEY_REM1]
+TEXT_COLUMNS = {'hotel', 'category'} | set(form.RATE_TEXT_COLUMNS)
+
+
+def random_row(rng: random.Random) -> list:
+    start = date(2026, 1, 1) + timedelta(days=rng.randrange(0, 365)); end = start + timedelta(days=rng.randrange(0, 60))
+    kind = rng.random()
+    return [rng.choice(['Ubud', 'Canggu']), f"Hotel {rng.randrange(4)}", rng.choice(['Deluxe', 'Villa']),
+            start.strftime(form.DATE_FORMAT), end.strftime(form.DATE_FORMAT), str(rng.randrange(500, 5000) * 1000),
+            str(rng.randrange(0, 3) * 100000),
+            (date(2026, 1, 1) + timedelta(days=rng.randrange(0, 365))).strftime(form.DATE_FORMAT) if kind < 0.2 else '',
+            f"SPO {rng.randrange(100)}" if kind < 0.2 else '', str(rng.choice([30, 60])) if 0.2 <= kind < 0.4 else '',
+            rng.choice(['', 'Breakfast', 'Transfer'])]
+
+def make_sync(values: list):
+    worksheet = FakeWorksheet(values)
+    return form.RateSheetSync(lambda: worksheet, snapshot_path=None), worksheet
+
+def table_groups(table: form.RateTable) -> dict:
+    # Содержимое таблицы без учета внутренних номеров строк и идентификаторов строк-текстов
+    def row_values(row):
+        return tuple(table.strings[table.columns[name][row]] if name in TEXT_COLUMNS else table.columns[name][row] for name in form.RATE_COLUMNS)
+    return {key: [row_values(row) for row in rows] for key, rows in table._groups.items() if rows}
+
+def rebuilt_groups(values: list) -> dict:
+    return table_groups(form.RateTable.from_records([form.sheet_row_record(values[0], row) for row in values[1:]]))
+
+
+def test_unchanged_update_time_skips_fetch():
+    rng = random.Random(1)
+    sync, worksheet = make_sync([HEADER] + [random_row(rng) for _ in range(20)])
+    assert sync.sync() is True
+    assert worksheet.fetches == 1 and sync.rows_parsed_last_sync == 20
+    worksheet.values.append(random_row(rng))  # без смены lastUpdateTime изменение не видно
+    assert sync.sync() is False
+    assert worksheet.fetches == 1
+
+def test_touched_sheet_without_changes_is_not_reparsed():
+    rng = random.Random(2)
+    sync, worksheet = make_sync([HEADER] + [random_row(rng) for _ in range(20)])
+    sync.sync(); rate_table = sync.rate_table
+    worksheet.touch()
+    assert sync.sync() is False
+    assert worksheet.fetches == 2 and sync.rate_table is rate_table
+
+class ForbiddenResponse:
+    status_code = 403; text = 'Drive API has not been used in project'
+    def json(self): return {'error': {'code': 403, 'message': self.text, 'status': 'PERMISSION_DENIED'}}
+
+class NoDriveSpreadsheet:
+    def get_lastUpdateTime(self): raise APIError(ForbiddenResponse())
+
+def test_failing_update_time_check_falls_back_to_row_hashes():
+    rng = random.Random(5)
+    sync, worksheet = make_sync([HEADER] + [random_row(rng) for _ in range(10)])
+    worksheet.spreadsheet = NoDriveSpreadsheet()
+    cache = form.RateSheetCache(sync)
+    assert cache.refresh() is True and cache.last_error is None
+    assert len(cache.get().rate_table) == 10
+    assert sync.sync() is False  # без времени изменения значения сравниваются по хэшам
+    worksheet.values.append(random_row(rng))
+    assert sync.sync() is True and sync.rows_parsed_last_sync == 1
+    assert table_groups(sync.rate_table) == rebuilt_groups(worksheet.values)
+
+def test_patch_parses_only_changed_rows():
+    rng = random.Random(3)
+    sync, worksheet = make_sync([HEADER] + [random_row(rng) for _ in range(30)])
+    sync.sync()
+    rows = worksheet.values
+    rows[5] = random_row(rng)  # правка
+    del rows[12]  # удаление
+    rows.insert(20, random_row(rng)); rows.insert(25, random_row(rng))  # вставки
+    worksheet.touch()
+    assert sync.sync() is True
+    assert sync.rows_parsed_last_sync == 3
+    assert table_groups(sync.rate_table) == rebuilt_groups(worksheet.values)
+
+def test_saved_snapshot_is_reloaded_from_mmap(tmp_path):
+    rng = random.Random(6)
+    worksheet = FakeWorksheet([HEADER] + [random_row(rng) for _ in range(30)])
+    sync = form.RateSheetSync(lambda: worksheet, snapshot_path=str(tmp_path / 'rates.bin'))
+    sync.sync()
+    assert isinstance(sync.rate_table.columns['start'], memoryview)
+    for _ in range(3):
+        del worksheet.values[rng.randrange(1, len(worksheet.values))]; worksheet.values.append(random_row(rng))
+        worksheet.touch(); assert sync.sync() is True
+        assert isinstance(sync.rate_table.columns['start'], memoryview) and sync.rate_table.dead_rows == 0
+        assert table_groups(sync.rate_table) == rebuilt_groups(worksheet.values)
+
+def test_patched_table_matches_full_rebuild():
+    rng = random.Random(4)
+    sync, worksheet = make_sync([HEADER] + [random_row(rng) for _ in range(60)])
+    sync.sync()
+    for _ in range(15):
+        rows = worksheet.values
+        for _ in range(rng.randrange(1, 6)):
+            action = rng.random(); position = rng.randrange(1, len(rows) + 1)
+            if action < 0.35: rows.insert(position, random_row(rng))
+            elif action < 0.7 and len(rows) > 2: del rows[min(position, len(rows) - 1)]
+            else: rows[min(position, len(rows) - 1)] = random_row(rng)
+        worksheet.touch(); sync.sync()
+        assert table_groups(sync.rate_table) == rebuilt_groups(worksheet.values)
+        assert sync.hotel_data == form.build_hotel_tree([form.sheet_row_record(HEADER, row) for row in worksheet.values[1:]])